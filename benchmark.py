@@ -0,0 +1,192 @@
+#!/usr/bin/python
+# benchmarks the parsing and dialogue pipeline against the bundled transcripts, and synthetic copies of them
+# that are 10x, 100x, ... as large. prints (or writes) JSON, and can compare against a previous run:
+#   python benchmark.py --scales 1,10,100 --output bench.json
+#   python benchmark.py --compare bench.json --tolerance 0.25
+
+import os
+import sys
+import json
+import copy
+import time
+import random
+import argparse
+import resource
+import subprocess
+
+os.chdir(os.path.dirname(os.path.abspath(__file__))) # addons load their data relative to the repo
+sys.path.insert(0, os.getcwd())
+
+import bot
+import lookup_addon
+
+corpus_files = ['polite.json', 'if_missing_fields.json', 'ask_weather.json', 'weather_addon.json', 'lookup_addon.json']
+
+utterances = [
+    u"hey",
+    u"good morning",
+    u"What's up?",
+    u"how's the weather?",
+    u"how's the weather in new york?",
+    u"weather in providence, ri",
+    u"what is the capital where names contains austria in countries ?",
+    u"get borders in countries where capital equals Vienna?",
+    u"I would like to know the capital of germany please if you can",
+    u"asdf qwer zxcv",
+]
+
+lookup_queries = [
+    {"~table": "countries", "predicate": "contains", "~query_field": "names", "~query_value": u"austria", "~lookup_field": "capital"},
+    {"~table": "countries", "predicate": "is", "~query_field": "capital", "~query_value": u"vienna", "~lookup_field": "borders"},
+    {"~table": "countries", "predicate": "equals", "~query_field": "capital", "~query_value": u"atlantis", "~lookup_field": "capital"},
+    {"~table": "nonexistent", "predicate": "is", "~query_field": "capital", "~query_value": u"paris", "~lookup_field": "capital"},
+]
+
+def load_corpus():
+    return [json.load(open(filename)) for filename in corpus_files]
+
+def synthetic_corpus(docs, scale, seed=0):
+    # `scale` copies of the corpus; every copy after the first prefixes each message with words from a synthetic
+    # vocabulary (which grows with the scale), so each copy adds distinct templates, intents and tokens
+    rng = random.Random(seed)
+    vocabulary = [u"w{0}".format(i) for i in xrange(50 * scale)]
+    def perturb(thread, copy_index):
+        for item in thread:
+            if isinstance(item, list):
+                for branch in item:
+                    perturb(branch['messages'], copy_index)
+            else:
+                if 'messages' in item:
+                    perturb(item['messages'], copy_index)
+                if item.get('text'):
+                    item['text'] = u" ".join(rng.sample(vocabulary, 2) + [item['text']])
+                if 'id' in item:
+                    item['id'] = u"{0}-{1}".format(item['id'], copy_index)
+    corpus = []
+    for copy_index in xrange(scale):
+        for doc in docs:
+            doc = copy.deepcopy(doc)
+            if copy_index > 0:
+                for transcript in doc['transcripts']:
+                    perturb(transcript['messages'], copy_index)
+            corpus.append(doc)
+    return corpus
+
+def percentile(sorted_samples, p):
+    # nearest-rank percentile
+    index = max(0, min(len(sorted_samples) - 1, int(round(p / 100.0 * len(sorted_samples) + 0.5)) - 1))
+    return sorted_samples[index]
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {"n": len(samples), "p50": percentile(samples, 50), "p99": percentile(samples, 99), "mean": sum(samples) / len(samples)}
+
+def timed(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return time.time() - start, result
+
+class Quiet(object):
+    # the bot logs to stdout, which is where our results go
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def scripted_convo(b, n_turns):
+    convo = bot.Convo()
+    for i in xrange(n_turns):
+        convo.append_message(b.parse_message(convo, utterances[i % len(utterances)], 'user'))
+        b.respond(convo)
+    return convo
+
+def run_scale(scale, iterations, build_iterations):
+    random.seed(0)
+    docs = synthetic_corpus(load_corpus(), scale)
+    results = {"scale": scale}
+    with Quiet():
+        build_samples = []
+        for i in xrange(build_iterations):
+            elapsed, b = timed(bot.Bot, docs)
+            build_samples.append(elapsed)
+        results["build"] = summarize(build_samples)
+        results["templates"] = len(b.message_templates)
+
+        scripted_convo(b, len(utterances)) # warm up, including bots that are created on first use
+        parse_samples, respond_samples = [], []
+        for i in xrange(iterations):
+            convo = bot.Convo()
+            elapsed, parse = timed(b.parse_message, convo, utterances[i % len(utterances)], 'user')
+            parse_samples.append(elapsed)
+            convo.append_message(parse)
+            elapsed, _ = timed(b.respond, convo)
+            respond_samples.append(elapsed)
+        results["parse_message"] = summarize(parse_samples)
+        results["respond"] = summarize(respond_samples)
+
+        convo = scripted_convo(b, 20)
+        serialize_samples, deserialize_samples = [], []
+        for i in xrange(iterations):
+            elapsed, data = timed(b.serialize_convo, convo)
+            serialize_samples.append(elapsed)
+            elapsed, _ = timed(b.deserialize_convo, data)
+            deserialize_samples.append(elapsed)
+        results["serialize_convo"] = summarize(serialize_samples)
+        results["deserialize_convo"] = summarize(deserialize_samples)
+        results["serialized_bytes"] = len(data)
+
+        addon = lookup_addon.Addon()
+        lookup_samples = []
+        for i in xrange(iterations):
+            elapsed, _ = timed(addon.lookup_field, lookup_queries[i % len(lookup_queries)])
+            lookup_samples.append(elapsed)
+        results["lookup_field"] = summarize(lookup_samples)
+    results["peak_memory_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+def run(scales, iterations, build_iterations):
+    # each scale runs in its own process, so that peak memory is measured per scale
+    results = {"python": sys.version.split()[0], "iterations": iterations, "scales": {}}
+    for scale in scales:
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--single-scale', str(scale), '--iterations', str(iterations), '--build-iterations', str(build_iterations)])
+        results["scales"][str(scale)] = json.loads(output)
+    return results
+
+def regressions(results, baseline, tolerance):
+    # (scale, operation, old p50, new p50) for every p50 that got more than `tolerance` slower
+    found = []
+    for scale, ops in results["scales"].iteritems():
+        for op, stats in ops.iteritems():
+            old_stats = baseline.get("scales", {}).get(scale, {}).get(op)
+            if isinstance(stats, dict) and isinstance(old_stats, dict) and stats["p50"] > old_stats["p50"] * (1 + tolerance):
+                found.append((scale, op, old_stats["p50"], stats["p50"]))
+    return found
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="benchmark the parsing and dialogue pipeline")
+    parser.add_argument('--scales', default='1,10,100,1000', help="comma-separated corpus multipliers")
+    parser.add_argument('--iterations', type=int, default=30, help="samples per operation")
+    parser.add_argument('--build-iterations', type=int, default=3, help="samples of building the bot")
+    parser.add_argument('--output', help="write results to this file instead of stdout")
+    parser.add_argument('--compare', help="a previous results file; exits 1 if any p50 regressed")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed fractional p50 slowdown when comparing")
+    parser.add_argument('--single-scale', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single_scale:
+        print json.dumps(run_scale(args.single_scale, args.iterations, args.build_iterations))
+        sys.exit(0)
+
+    results = run([int(scale) for scale in args.scales.split(',')], args.iterations, args.build_iterations)
+    if args.output:
+        json.dump(results, open(args.output, 'w'), indent=2, sort_keys=True)
+    else:
+        print json.dumps(results, indent=2, sort_keys=True)
+
+    if args.compare:
+        found = regressions(results, json.load(open(args.compare)), args.tolerance)
+        for scale, op, old, new in found:
+            print >> sys.stderr, "REGRESSION at {0}x: {1} p50 {2:.6f}s -> {3:.6f}s".format(scale, op, old, new)
+        sys.exit(1 if len(found) else 0)
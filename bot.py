@@ -1,5 +1,6 @@
 import json
-from collections import defaultdict
+import sys
+from collections import defaultdict, deque
 import null_phrase
 import parse_example
 import random
@@ -10,6 +11,13 @@ import importlib
 import datetime
 import pickle
 import StringIO
+import marshal
+import multiprocessing
+import os
+import mmap
+import struct
+import hashlib
+import tempfile
 
 # TODO: give a bonus to previously traversed messages
 # TODO: give a bonus to messages with similar fields
@@ -18,59 +26,83 @@ SUBSEQUENT_MESSAGE_BONUS = 10
 INITIAL_MESSAGE_BONUS = 7
 NULL_BONUS = 9
 MISSING_FIELDS_BONUS = 0.5
+CONVO_WINDOW = 20 # how many recent messages a convo keeps; convo.fields holds everything older ones set
+
+# serialized convos start with CONVO_FORMAT_MAGIC and a version byte; anything else is an older pickled convo
+CONVO_FORMAT_MAGIC = 'BMC'
+CONVO_FORMAT_VERSION = 1
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# model artifacts (see Bot.write_artifact) start with MODEL_FORMAT_MAGIC and a version byte, and are only used
+# if they were built from the same JSON files, addon modules and model-building code as we have now
+MODEL_FORMAT_MAGIC = 'BMM'
+MODEL_FORMAT_VERSION = 3
+MODEL_SOURCE_MODULES = ['commanding', 'parse_example', 'null_phrase']
 
 def chain(lists):
     return reduce(lambda a,b: a+b, lists, [])
 
 class Bot(object):
-    def __init__(self, json_docs):
+    def __init__(self, json_docs, lazy=False, model_options={}):
+        # lazy=True leaves building the model to the first parse. `model_options` are passed to the
+        # commanding.CompiledModel. the default python backend is the fastest for parse_message, which decodes by
+        # branch and bound; {'backend': 'numpy'} is for models shared with a commanding.ParsePool
+        self.model_options = model_options
         self.initial_message_templates = []
         self.message_templates = {}
+        self.templates_in_order = [] # every template, in the order they were added
+        self.addons = [] # (module name, Addon) for each doc with an addon_module
         self._last_message_id = 0
+        # indexes, kept up to date by add_template:
+        self.allowed_intents_for_senders = defaultdict(lambda: set([''])) # sender -> template ids, plus the null intent
+        self.required_fields_for_templates = {} # template id -> fields
+        self.templates_requiring_fields = defaultdict(set) # field -> template ids
+        self._prepared = False
+        self.load_model_tables = None # set by from_artifact
         
         for doc in json_docs:
             if 'addon_module' in doc:
                 self._current_addon = importlib.import_module(doc['addon_module']).Addon()
+                self.addons.append((doc['addon_module'], self._current_addon))
             for t in doc['transcripts']:
                 self.load_message_thread(t['messages'], True, [])
             self._current_addon = None
+        if not lazy:
+            self.prepare()
         
         self.bots_for_names = {}
         self.convos_with_named_bots = defaultdict(Convo)
         self.log_name = 'bot'
     
-    def load_message_thread(self, thread, assume_sender_is_user, parent_messages, condition=None):
+    def load_message_thread(self, thread, assume_sender_is_user, parent_messages, condition_spec=None):
         for item in thread:
             if isinstance(item, list):
                 # branch:
                 final_messages = []
                 outbound_assume_sender_is_user = assume_sender_is_user
                 for branch in item:
-                    outbound_messages, outbound_assume_sender_is_user = self.load_message_thread(branch['messages'], assume_sender_is_user, parent_messages, condition)
+                    outbound_messages, outbound_assume_sender_is_user = self.load_message_thread(branch['messages'], assume_sender_is_user, parent_messages, condition_spec)
                     final_messages += outbound_messages
                 parent_messages = final_messages
                 assume_sender_is_user = outbound_assume_sender_is_user
                 only_enter_if_missing_field = None
             else:
-                child_condition = self.condition_from_dict(item)
-                if child_condition:
-                    branch_parent_messages, _ = self.load_message_thread(item['messages'], assume_sender_is_user, parent_messages, condition=child_condition)
+                child_condition_spec = condition_spec_from_dict(item)
+                if child_condition_spec:
+                    branch_parent_messages, _ = self.load_message_thread(item['messages'], assume_sender_is_user, parent_messages, condition_spec=child_condition_spec)
                     parent_messages += branch_parent_messages
                 else:
                     sender = item.get('sender', 'user' if assume_sender_is_user else 'bot')
                     run_function = None
+                    code = None
                     if 'code' in item:
                         run_function = getattr(self._current_addon, item['code'])
+                        code = (len(self.addons) - 1, item['code'])
                     id = str(self._last_message_id + 1)
                     self._last_message_id += 1
-                    template_msg = TemplateMessage(item.get('text', ''), sender, item.get('id', id), run_function, condition)
-                    self.message_templates[template_msg.id] = template_msg
-                
-                    if len(parent_messages) == 0:
-                        self.initial_message_templates.append(template_msg)
-                    else:
-                        for parent in parent_messages:
-                            template_msg.add_parent(parent)
+                    template_msg = TemplateMessage(item.get('text', ''), sender, item.get('id', id), run_function, self.condition_from_dict(condition_spec),
+                                                   code=code, condition_spec=condition_spec)
+                    self.add_template(template_msg, parent_messages)
                             
                     assume_sender_is_user = sender != 'user'  
                     parent_messages = [template_msg]
@@ -78,8 +110,55 @@ class Bot(object):
         
         return parent_messages, assume_sender_is_user
     
+    def add_template(self, template, parent_messages):
+        self.message_templates[template.id] = template
+        self.templates_in_order.append(template)
+        self.allowed_intents_for_senders[template.sender].add(template.id)
+        if len(parent_messages) == 0:
+            self.initial_message_templates.append(template)
+        else:
+            for parent in parent_messages:
+                template.add_parent(parent)
+        self.update_required_fields(template)
+        self.templates_changed()
+    
+    def update_required_fields(self, template):
+        # refreshes the required fields of `template` and everything downstream of it, parents first,
+        # so each template's fields are computed once from its parents' memoized ones
+        for t in topological_order(template.descendants()):
+            for field in self.required_fields_for_templates.pop(t.id, ()):
+                self.templates_requiring_fields[field].discard(t.id)
+                if len(self.templates_requiring_fields[field]) == 0:
+                    del self.templates_requiring_fields[field]
+            required_fields = t.required_fields()
+            if len(required_fields) > 0:
+                self.required_fields_for_templates[t.id] = required_fields
+                for field in required_fields:
+                    self.templates_requiring_fields[field].add(t.id)
+    
+    def templates_changed(self):
+        # call after adding or changing templates; parse_message will re-run `prepare`
+        self._prepared = False
+        self.load_model_tables = None
+    
+    def prepare(self):
+        # precomputes everything parse_message needs that doesn't depend on the convo or the message
+        if self._prepared:
+            return
+        if self.load_model_tables:
+            self.model = commanding.CompiledModel.from_tables(self.load_model_tables(), **self.model_options)
+        else:
+            templates = self.message_templates.values()
+            examples = [example for template in templates for example in template.examples] + null_phrase.examples()
+            self.model = commanding.CompiledModel(examples, **self.model_options)
+        
+        self.base_intent_bonuses = {'': NULL_BONUS}
+        for template in self.initial_message_templates:
+            self.base_intent_bonuses[template.id] = INITIAL_MESSAGE_BONUS
+        self._prepared = True
+    
     def condition_from_dict(self, item):
-        if 'if_missing_field' in item:
+        if item and 'if_missing_field' in item:
             field = item['if_missing_field']
             def fn(convo):
                 fields = self.fields_from_convo(convo)
@@ -87,6 +166,53 @@ class Bot(object):
             return fn
         return None
     
+    def write_artifact(self, path, json_filenames):
+        # writes our templates and compiled model to `path`, for `from_artifact`. `json_filenames` are the files
+        # we were built from. sections are marshalled: (source digest, addon modules), then
+        # (last message id, [template]) where templates refer to their parents by position, then the model's tables
+        self.prepare()
+        addon_modules = [name for name, addon in self.addons]
+        positions = dict((template, i) for i, template in enumerate(self.templates_in_order))
+        templates = [(t.text, t.sender, t.id, t.code, t.condition_spec, [positions[p] for p in t.parents], [(e.intent, e.items) for e in t.examples]) for t in self.templates_in_order]
+        sections = [(source_digest(json_filenames, addon_modules), addon_modules), (self._last_message_id, templates), self.model.tables()]
+        data = MODEL_FORMAT_MAGIC + chr(MODEL_FORMAT_VERSION)
+        for section in sections:
+            section = marshal.dumps(section, 2)
+            data += struct.pack('<I', len(section)) + section
+        # write to a temporary file of our own and rename it over `path`, so that a concurrent from_artifact never
+        # sees half a file, and processes writing at once don't write into each other's:
+        fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(path) or '.')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(temp_path, path)
+    
+    @classmethod
+    def from_artifact(cls, path, json_filenames, model_options={}):
+        # the bot saved to `path` by write_artifact, or None if there's no artifact there, or it's from another
+        # format version, or it's stale. the file is mapped rather than read, and the model section is only decoded on the first parse
+        try:
+            with open(path, 'rb') as f:
+                region = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            sections = artifact_sections(region)
+            (digest, addon_modules) = marshal.loads(region[sections[0][0]:sections[0][1]])
+        except (EnvironmentError, ValueError, EOFError, TypeError, struct.error):
+            return None
+        if digest != source_digest(json_filenames, addon_modules):
+            return None
+        
+        bot = cls([], lazy=True, model_options=model_options)
+        bot.addons = [(name, importlib.import_module(name).Addon()) for name in addon_modules]
+        last_message_id, templates = marshal.loads(region[sections[1][0]:sections[1][1]])
+        for text, sender, id, code, condition_spec, parents, examples in templates:
+            run_function = getattr(bot.addons[code[0]][1], code[1]) if code else None
+            template = TemplateMessage(text, sender, id, run_function, bot.condition_from_dict(condition_spec),
+                                       [commanding.Phrase(*example) for example in examples], code, condition_spec)
+            bot.add_template(template, [bot.templates_in_order[i] for i in parents])
+        bot._last_message_id = last_message_id
+        start, end = sections[2]
+        bot.load_model_tables = lambda: marshal.loads(region[start:end])
+        return bot
+    
     def log(self, *args):
         print ' [{0}]'.format(self.log_name), ", ".join(map(str, args))
     
@@ -96,9 +222,9 @@ class Bot(object):
             convo = self.deserialize_convo(convo_data)
             text = raw_input(" > ")
             if text == '': break
-            convo_len = len(convo.messages)
+            message_count = convo.message_count
             self.send_message_and_get_immediate_response(convo, text)
-            for message in convo.messages[convo_len+1:]:
+            for message in convo.messages_since(message_count+1):
                 color = 'blue' if message.sender == 'bot' else 'red'
                 print colored(message.text, color)
             convo_data = self.serialize_convo(convo)
@@ -107,48 +233,100 @@ class Bot(object):
         parse = self.parse_message(convo, text, 'user')
         convo.append_message(parse)
         self.log("Parsed as:", parse)
-        convo_len = len(convo.messages)
+        message_count = convo.message_count
         # print " Other examples of this:", u"|".join([x.text() for x in self.examples_for_message_ids[parse.message_id]])
         self.respond(convo)
         
-        new_messages = convo.messages[convo_len:]
+        new_messages = convo.messages_since(message_count)
         responses = [msg for msg in new_messages if msg.sender == 'bot' and msg.text != '' and msg.text[0] != '@']
         if len(responses) != 1:
             self.log("WARNING: bot returned {0} direct responses; expected 1".format(len(responses)))
         return responses[0] if len(responses) else response
     
     def parse_message(self, convo, text, sender):
-        # create message-matching bonuses:
+        self.prepare()
+        intent_bonuses = dict(self.base_intent_bonuses)
+        intent_bonuses.update(self.convo_intent_bonuses(convo))
+        parse = self.model.parse(text, intent_bonuses=intent_bonuses, allowed_intents=self.allowed_intents_for_senders[sender], bound=True)
+        return self.parsed_message(text, sender, parse)
+    
+    def parse_session(self, convo, sender='user', text=u""):
+        # a commanding.ParseSession that parses what `sender` is typing as parse_message would in `convo`;
+        # pass its best() to parsed_message for the ParsedMessage
+        self.prepare()
+        intent_bonuses = dict(self.base_intent_bonuses)
+        intent_bonuses.update(self.convo_intent_bonuses(convo))
+        return commanding.ParseSession(self.model, text, intent_bonuses, self.allowed_intents_for_senders[sender])
+    
+    def parse_messages(self, convos, texts, sender='user', processes=None):
+        # parses each of `texts` as parse_message would in the matching convo, without appending anything.
+        # texts are grouped by their convo's intent bonuses, and each distinct text is parsed once per group.
+        # with processes > 1, the distinct texts are split between that many forked worker processes.
+        # with the numpy backend (see model_options), texts with the same number of tokens are decoded as one batch
+        self.prepare()
+        groups = defaultdict(list) # bonus profile -> indices into texts
+        bonuses_for_profiles = {}
+        for index, convo in enumerate(convos):
+            convo_bonuses = self.convo_intent_bonuses(convo)
+            profile = tuple(sorted(convo_bonuses.iteritems()))
+            if profile not in bonuses_for_profiles:
+                bonuses_for_profiles[profile] = dict(self.base_intent_bonuses)
+                bonuses_for_profiles[profile].update(convo_bonuses)
+            groups[profile].append(index)
+        
+        # a worker's share is a list of (bonuses, texts, indices) groups:
+        workers = max(1, processes or 1)
+        worker_for_texts = {}
+        shares = [[] for i in xrange(workers)]
+        for profile, indices in groups.iteritems():
+            indices_for_workers = [[] for i in xrange(workers)]
+            for index in indices:
+                worker = worker_for_texts.setdefault(texts[index], len(worker_for_texts) % workers)
+                indices_for_workers[worker].append(index)
+            for share, indices in zip(shares, indices_for_workers):
+                if len(indices):
+                    share.append((bonuses_for_profiles[profile], [texts[i] for i in indices], indices))
+        
+        if workers > 1:
+            parses = parse_shares_in_processes(self, [[(bonuses, group_texts) for bonuses, group_texts, indices in share] for share in shares], sender, workers)
+        else:
+            parses = [self.parse_share([(bonuses, group_texts) for bonuses, group_texts, indices in share], sender) for share in shares]
+        
+        messages = [None] * len(texts)
+        for share, share_parses in zip(shares, parses):
+            for (bonuses, group_texts, indices), group_parses in zip(share, share_parses):
+                for index, parse in zip(indices, group_parses):
+                    messages[index] = self.parsed_message(texts[index], sender, parse)
+        return messages
+    
+    def parse_share(self, groups, sender):
+        # parses (bonuses, texts) groups. the python per-intent decoder parses each group's texts by branch and bound,
+        # as parse_message does; the joint and numpy decoders ignore bound and share their decoding between the groups
+        decoded = {}
+        return [self.model.parse_many(texts, intent_bonuses=bonuses, allowed_intents=self.allowed_intents_for_senders[sender], decoded=decoded, bound=True) for bonuses, texts in groups]
+    
+    def convo_intent_bonuses(self, convo):
+        # the message-matching bonuses that depend on the state of the convo; they take precedence over base_intent_bonuses
         intent_bonuses = {}
-        intent_bonuses[''] = NULL_BONUS
-        for template in self.initial_message_templates:
-            intent_bonuses[template.id] = INITIAL_MESSAGE_BONUS
         
         # which message is this in response to? it's the most recent parseable message sent by the bot
-        prompt_messages = [m for m in convo.messages if m.parse and m.sender == 'bot']
-        if len(prompt_messages) > 0:
-            for child in prompt_messages[-1].template.applicable_children(convo):
+        if convo.last_prompt:
+            for child in convo.last_prompt.template.applicable_children(convo):
                 intent_bonuses[child.id] = SUBSEQUENT_MESSAGE_BONUS
         
         # apply penalty to parses that have fields that aren't currently present:
-        fields = convo.fields
-        for template in self.message_templates.itervalues():
-            missing_fields = [field for field in template.required_fields() if field not in fields]
-            if len(missing_fields) > 0:
-                intent_bonuses[template.id] = MISSING_FIELDS_BONUS ** len(missing_fields)
-        
-        allowed_intents = set((template.id for template in self.message_templates.itervalues() if template.sender == sender))
-        allowed_intents.add('')
-        # print self.examples
-        
-        examples = reduce(lambda a,b: a+b, (t.examples for t in self.message_templates.itervalues())) + null_phrase.examples()
-        
-        parse = commanding.parse_phrase(text, examples, intent_bonuses=intent_bonuses, allowed_intents=allowed_intents)
+        missing_field_counts = defaultdict(int)
+        for field in self.templates_requiring_fields.viewkeys() - convo.fields.viewkeys():
+            for template_id in self.templates_requiring_fields[field]:
+                missing_field_counts[template_id] += 1
+        for template_id, n_missing_fields in missing_field_counts.iteritems():
+            intent_bonuses[template_id] = MISSING_FIELDS_BONUS ** n_missing_fields
+        return intent_bonuses
+    
+    def parsed_message(self, text, sender, parse):
         if parse and parse.intent != '':
-            msg = ParsedMessage(text, sender, parse, self.message_templates[parse.intent])
-        else:
-            msg = ParsedMessage(text, sender, None, None)
-        return msg
+            return ParsedMessage(text, sender, parse, self.message_templates[parse.intent])
+        return ParsedMessage(text, sender, None, None)
     
     def respond(self, convo):
         # appends responses to convo        
@@ -207,22 +385,32 @@ class Bot(object):
     
     def _bot_with_name(self, name):
         if name == 'weatherbot':
-            files = ['weather_addon.json']
-            b = Bot([json.load(open(filename)) for filename in files])
-            return b
+            return load_bot(['weather_addon.json'], 'weatherbot.model.bin', self.model_options)
         print "No bot named", name
     
     def serialize_convo(self, convo):
+        try:
+            return encode_convo(convo)
+        except ValueError:
+            # a field holds something marshal can't encode
+            return self.pickle_convo(convo)
+    
+    def deserialize_convo(self, data):
+        if data.startswith(CONVO_FORMAT_MAGIC):
+            return decode_convo(data, self.message_templates)
+        return self.unpickle_convo(data)
+    
+    def pickle_convo(self, convo):
         def persistent_id(obj):
             if isinstance(obj, TemplateMessage):
                 return obj.id
         data = StringIO.StringIO()
         p = pickle.Pickler(data)
-        p.persistent_id = persistent_id # TODO: trim the convo length to ~ 20 or so
+        p.persistent_id = persistent_id
         p.dump(convo)
         return data.getvalue()
     
-    def deserialize_convo(self, data):
+    def unpickle_convo(self, data):
         f = StringIO.StringIO(data)
         p = pickle.Unpickler(f)
         def persistent_load(id):
@@ -231,14 +419,34 @@ class Bot(object):
         return p.load()
 
 class Convo(object):
-    def __init__(self):
-        self.messages = []
+    def __init__(self, window=CONVO_WINDOW):
+        self.messages = deque(maxlen=window) # only the most recent `window` messages
         self.fields = {}
+        self.message_count = 0 # every message ever appended, including ones that fell out of the window
+        self.last_prompt = None # the most recent parseable message sent by the bot, even if it fell out of the window
     
     def append_message(self, message):
         self.messages.append(message)
+        self.message_count += 1
         if message.parse:
             self.import_fields(message.parse.tags())
+            if message.sender == 'bot':
+                self.last_prompt = message
+    
+    def messages_since(self, message_count):
+        # the messages appended since the convo had `message_count` messages (as many as are still in the window)
+        n_new = max(0, min(self.message_count - message_count, len(self.messages)))
+        return list(self.messages)[len(self.messages)-n_new:]
+    
+    def __setstate__(self, state):
+        # convos pickled before the window existed have an unbounded message list
+        self.__dict__.update(state)
+        if not isinstance(self.messages, deque):
+            messages = self.messages
+            self.messages = deque(messages, maxlen=CONVO_WINDOW)
+            self.message_count = len(messages)
+            prompts = [m for m in messages if m.parse and m.sender == 'bot']
+            self.last_prompt = prompts[-1] if len(prompts) else None
     
     def import_fields(self, fields):
         for k,v in fields.iteritems():
@@ -248,16 +456,127 @@ class Convo(object):
             else:
                 self.fields[k] = v
 
+def condition_spec_from_dict(item):
+    # the part of a transcript item that conditions its messages, if any (see Bot.condition_from_dict)
+    if 'if_missing_field' in item:
+        return {'if_missing_field': item['if_missing_field']}
+    return None
+
+def load_bot(json_filenames, artifact_path, model_options={}):
+    # the bot for `json_filenames`, from the artifact at `artifact_path` if it's up to date. otherwise it's built
+    # from the JSON, and the artifact rewritten if possible (App Engine's filesystem is read-only, so deploy one built by build_model.py)
+    bot = Bot.from_artifact(artifact_path, json_filenames, model_options)
+    if bot == None:
+        bot = Bot([json.load(open(filename)) for filename in json_filenames], model_options=model_options)
+        try:
+            bot.write_artifact(artifact_path, json_filenames)
+        except EnvironmentError:
+            pass
+    return bot
+
+def source_digest(json_filenames, addon_modules):
+    # a hash of the JSON files, the addon modules' source and the code that builds the model
+    paths = list(json_filenames) + [module_source_path(name) for name in MODEL_SOURCE_MODULES + list(addon_modules)] + [module_source_path(__name__)]
+    digest = hashlib.sha1()
+    for path in paths:
+        data = open(path, 'rb').read()
+        digest.update('{0}:{1}\n'.format(os.path.basename(path), len(data)))
+        digest.update(data)
+    return digest.hexdigest()
+
+def module_source_path(name):
+    module = sys.modules.get(name) or importlib.import_module(name)
+    return os.path.splitext(module.__file__)[0] + '.py'
+
+def artifact_sections(data):
+    # the (start, end) offsets of each marshalled section of a model artifact; raises ValueError if it isn't one
+    if data[:len(MODEL_FORMAT_MAGIC)] != MODEL_FORMAT_MAGIC or ord(data[len(MODEL_FORMAT_MAGIC)]) != MODEL_FORMAT_VERSION:
+        raise ValueError("not a version {0} model artifact".format(MODEL_FORMAT_VERSION))
+    sections = []
+    offset = len(MODEL_FORMAT_MAGIC) + 1
+    while offset < len(data):
+        length, = struct.unpack('<I', data[offset:offset+4])
+        sections.append((offset + 4, offset + 4 + length))
+        offset += 4 + length
+    if len(sections) != 3 or offset != len(data):
+        raise ValueError("truncated model artifact")
+    return sections
+
+# parse_shares_in_processes hands the bot to its workers by forking, rather than pickling it for each task
+worker_bot = None
+
+def parse_share_in_worker(args):
+    groups, sender = args
+    return worker_bot.parse_share(groups, sender)
+
+def parse_shares_in_processes(bot, shares, sender, processes):
+    global worker_bot
+    worker_bot = bot
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(parse_share_in_worker, [(groups, sender) for groups in shares])
+    finally:
+        pool.close()
+        pool.join()
+        worker_bot = None
+
+def encode_message(message):
+    # (text, sender, template id, the parse's tags or None, microseconds since EPOCH). the text already holds the rest
+    # of the parse; a message's parse intent is always its template's id
+    time = message.time - EPOCH
+    return (message.text, message.sender, message.template.id if message.template else None, message.parse.tags() if message.parse else None,
+            (time.days * 86400 + time.seconds) * 1000000 + time.microseconds)
+
+def decode_message(encoded, message_templates):
+    # the parse is rebuilt as just its tags
+    text, sender, template_id, tags, time = encoded
+    parse = commanding.Phrase(template_id, [[name, value] for name, value in sorted(tags.iteritems())]) if tags != None else None
+    message = ParsedMessage(text, sender, parse, message_templates.get(template_id))
+    message.time = EPOCH + datetime.timedelta(microseconds=time)
+    return message
+
+def encode_convo(convo):
+    # the compact format: the header, then a marshalled (fields, [message], window, message count, last prompt) tuple.
+    # the last prompt is its index in the messages if it's still in the window, otherwise the message itself.
+    # raises ValueError if a field or parse item isn't made of plain types
+    messages = list(convo.messages)
+    last_prompt = None
+    if convo.last_prompt:
+        indices = [i for i, message in enumerate(messages) if message is convo.last_prompt]
+        last_prompt = indices[-1] if len(indices) else encode_message(convo.last_prompt)
+    return CONVO_FORMAT_MAGIC + chr(CONVO_FORMAT_VERSION) + marshal.dumps(
+        (convo.fields, map(encode_message, messages), convo.messages.maxlen, convo.message_count, last_prompt), 2)
+
+def decode_convo(data, message_templates):
+    version = ord(data[len(CONVO_FORMAT_MAGIC)])
+    if version != CONVO_FORMAT_VERSION:
+        raise ValueError("unknown convo format version: {0}".format(version))
+    fields, messages, window, message_count, last_prompt = marshal.loads(data[len(CONVO_FORMAT_MAGIC)+1:])
+    messages = [decode_message(m, message_templates) for m in messages]
+    if isinstance(last_prompt, int):
+        last_prompt = messages[last_prompt]
+    elif last_prompt:
+        last_prompt = decode_message(last_prompt, message_templates)
+    convo = Convo(window)
+    convo.fields = fields
+    convo.messages.extend(messages)
+    convo.message_count = message_count
+    convo.last_prompt = last_prompt
+    return convo
+
 class TemplateMessage(object):
-    def __init__(self, text, sender, id, run_function=None, condition=None):
+    def __init__(self, text, sender, id, run_function=None, condition=None, examples=None, code=None, condition_spec=None):
         self.text = text
         self.sender = sender
         self.parents = []
         self.children = []
         self.condition = condition # a function that takes the convo as input
         self.run_function = run_function
+        self.code = code # (index into the bot's addons, function name) that run_function came from
+        self.condition_spec = condition_spec # the transcript item fields that condition came from
         self.id = id
-        self.examples = [parse_example.parse_example_to_phrase(self.id, text)]
+        self.examples = examples if examples != None else [parse_example.parse_example_to_phrase(self.id, text)]
+        self._required_fields = None
     
     def applicable_children(self, convo):
         unconditioned = []
@@ -272,16 +591,39 @@ class TemplateMessage(object):
     def add_parent(self, parent):
         parent.children.append(self)
         self.parents.append(parent)
+        self.forget_required_fields()
+    
+    def descendants(self):
+        # this template and everything reachable through its children
+        found = set([self])
+        frontier = [self]
+        while len(frontier):
+            for child in frontier.pop().children:
+                if child not in found:
+                    found.add(child)
+                    frontier.append(child)
+        return found
     
     def required_fields(self):
-        # the fields that the user has sent us by now
-        
-        # TODO: predict required fields if we have parent nodes conditioned on getting a specific field
-        def intersection_of_sets(sets): return reduce(lambda a,b: a & b, sets, set())
-        reqs = intersection_of_sets([p.required_fields() for p in self.parents])
-        if self.sender != 'bot':
-            reqs = reqs | intersection_of_sets([set(e.tags().keys()) for e in self.examples])
-        return reqs
+        # the fields that the user has sent us by now; memoized, since they're built from our parents'
+        if self._required_fields == None:
+            # TODO: predict required fields if we have parent nodes conditioned on getting a specific field
+            def intersection_of_sets(sets): return reduce(lambda a,b: a & b, sets, set())
+            reqs = intersection_of_sets([p.required_fields() for p in self.parents])
+            if self.sender != 'bot':
+                reqs = reqs | intersection_of_sets([set(e.tags().keys()) for e in self.examples])
+            self._required_fields = reqs
+        return self._required_fields
+    
+    def forget_required_fields(self):
+        # drops our memoized required fields, and our descendants' (which were built from ours).
+        # a template's fields are only memoized after its parents' are, so we can stop at any that aren't
+        stale = [self]
+        while len(stale):
+            template = stale.pop()
+            if template._required_fields != None:
+                template._required_fields = None
+                stale.extend(template.children)
     
     def fields_to_fill(self):
         return set(self.examples[0].tags().iterkeys())
@@ -289,6 +631,22 @@ class TemplateMessage(object):
     def __repr__(self):
         return u"TemplateMessage({0})".format(self.text)
 
+def topological_order(templates):
+    # orders `templates` so that each one comes after any of its parents that are also in `templates`
+    templates = set(templates)
+    parents_left = dict((t, len([p for p in t.parents if p in templates])) for t in templates)
+    ready = [t for t in templates if parents_left[t] == 0]
+    order = []
+    while len(ready):
+        template = ready.pop()
+        order.append(template)
+        for child in template.children:
+            if child in parents_left:
+                parents_left[child] -= 1
+                if parents_left[child] == 0:
+                    ready.append(child)
+    return order
+
 class ParsedMessage(object):
     def __init__(self, text, sender, parse, template):
         self.text = text
@@ -304,6 +662,6 @@ if __name__ == '__main__':
     # files = ['weather_addon.json']
     files = ['polite.json', 'if_missing_fields.json', 'ask_weather.json']
     # files = ['polite.json', 'lookup_addon.json']
-    b = Bot([json.load(open(filename)) for filename in files])
+    b = load_bot(files, 'bot.model.bin')
     # b.bot_with_name('weatherbot').interact()
     b.interact()
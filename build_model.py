@@ -0,0 +1,16 @@
+#!/usr/bin/python
+# writes the precompiled model artifact that bot.load_bot reads, so that instances don't rebuild the model on
+# every cold start. run it before deploying, whenever the transcripts, addons or model code change:
+#   python build_model.py bot.model.bin polite.json if_missing_fields.json ask_weather.json
+#   python build_model.py weatherbot.model.bin weather_addon.json
+
+import sys
+import json
+import bot
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print "usage: python build_model.py <artifact path> <transcript json>..."
+        sys.exit(1)
+    path, filenames = sys.argv[1], sys.argv[2:]
+    bot.Bot([json.load(open(filename)) for filename in filenames]).write_artifact(path, filenames)
@@ -1,8 +1,20 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import math
 import re
 import unicodedata
 import copy
+import random
+import mmap
+import itertools
+import threading
+import traceback
+import multiprocessing
+import Queue
+import time
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class ProbabilityCounter(object):
     def __init__(self):
@@ -19,11 +31,25 @@ class ProbabilityCounter(object):
     def iteritems(self):
         return ((item, count * 1.0 / self.total) for (item, count) in self.counts.iteritems())
     
+    def freeze(self, key=None, default=None):
+        # a LogProbTable of our items' smoothed log-probabilities, optionally keyed by `key(item)` instead of the item.
+        # unseen items get `default`, or the smoothed log-prob of 0
+        log_probs = ((key(item) if key else item, smooth_log_prob(p)) for item, p in self.iteritems())
+        return LogProbTable(log_probs, smooth_log_prob(0) if default == None else default)
+    
     def __repr__(self):
       return str(dict(self.iteritems()))
 
+class LogProbTable(dict):
+    # smoothed log-probabilities, worked out once (see ProbabilityCounter.freeze); look items up with
+    # table.get(item, table.default), since `default` is the log-prob of anything not in the table
+    def __init__(self, log_probs, default):
+        dict.__init__(self, log_probs)
+        self.default = default
+
 SMOOTHING = 0.00001
 FREE_TEXT_PROB = 0.0001
+BOUND_SLACK = 1e-9 # relative slack on branch-and-bound comparisons, so rounding can't prune a tie
 
 def smooth_log_prob(p):
     return math.log((p+SMOOTHING) * (1 - SMOOTHING))
@@ -116,21 +142,162 @@ def flatten(list_of_lists):
     return flatten(map(lambda s: re.split(regex, s), strings))
 """
 
+class LRUCache(object):
+    # a mapping that forgets its least-recently-used items once it holds more than `max_size`; safe to share between threads
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            value = self.items.pop(key)
+            self.items[key] = value
+            return value
+    
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+    
+    def __len__(self):
+        with self.lock:
+            return len(self.items)
+
+class PrefixNode(object):
+    # a node of a PrefixCache trie: {key: (scores, backpointers, floor)} of the Viterbi columns decoded after the
+    # tokens on the path here, which may have been pruned of nodes below `floor`. `used` is when it was last used,
+    # by the cache's clock. `evicted` is set once it's out of the trie, for decodes that were still adding to it
+    __slots__ = ['children', 'columns', 'size', 'used', 'evicted']
+    def __init__(self, used):
+        self.children = {}
+        self.columns = {}
+        self.size = 0
+        self.used = used
+        self.evicted = False
+
+class PrefixCache(object):
+    # a trie of token prefixes -> the Viterbi columns decoded after them (per weight_first_word), so decoding a
+    # text can resume from its longest cached prefix. only the first `max_depth` tokens' columns are kept: openings
+    # are what texts share, and keeping every column costs more than it saves.
+    # once it holds more than `max_size` scores and backpointers in all, `evict` forgets the least-recently-used
+    # prefixes (and their extensions, which were used no more recently) until it's back to `EVICT_TO` of that.
+    # `stats` counts lookups, hits (lookups that resumed past the start), and the tokens resumed past and decoded.
+    # safe to share between threads: the trie and stats only change under `lock`, and cached columns never change
+    EVICT_TO = 0.75
+    
+    def __init__(self, max_size, max_depth=6):
+        self.max_size = max_size
+        self.max_depth = max_depth
+        self.roots = {}
+        self.size = 0
+        self.clock = 0
+        self.lock = threading.Lock()
+        self.stats = {'lookups': 0, 'hits': 0, 'tokens_reused': 0, 'tokens_decoded': 0, 'evictions': 0}
+    
+    def hit_rate(self):
+        return self.stats['hits'] * 1.0 / self.stats['lookups'] if self.stats['lookups'] else 0.0
+    
+    def prefixes(self, weight_first_word, tokens):
+        # the trie node for each of the first `max_depth` prefixes of `tokens`, marked as just used
+        with self.lock:
+            self.clock += 1
+            node = self.roots.get(weight_first_word)
+            if node == None:
+                node = self.roots[weight_first_word] = PrefixNode(self.clock)
+            nodes = []
+            for token in tokens[:self.max_depth]:
+                child = node.children.get(token)
+                if child == None:
+                    child = node.children[token] = PrefixNode(self.clock)
+                child.used = self.clock
+                nodes.append(child)
+                node = child
+            return nodes
+    
+    def resume(self, prefixes, key, n_tokens, floor):
+        # `key`'s cached column after each token of the longest of `prefixes` that has one, using only columns pruned
+        # at or below `floor` (one pruned higher may be missing nodes this decode needs)
+        with self.lock:
+            path = []
+            for node in prefixes:
+                column = node.columns.get(key)
+                if column == None or column[2] > floor:
+                    break
+                path.append(column)
+            self.stats['lookups'] += 1
+            self.stats['hits'] += 1 if len(path) else 0
+            self.stats['tokens_reused'] += len(path)
+            self.stats['tokens_decoded'] += n_tokens - len(path)
+            return path
+    
+    def store(self, node, key, scores, pointers, floor):
+        # caches `key`'s column after `node`'s prefix, unless one at least as complete is there
+        with self.lock:
+            column = node.columns.get(key)
+            if not node.evicted and (column == None or column[2] > floor):
+                size = len(scores) + len(pointers) - (len(column[0]) + len(column[1]) if column else 0)
+                node.columns[key] = (scores, pointers, floor)
+                node.size += size
+                self.size += size
+    
+    def evict(self):
+        with self.lock:
+            # trie nodes, with their parents, least recently used first; a node is no older than its children, so these
+            # come before it in ties:
+            nodes = []
+            stack = [(root, None, None, 0) for root in self.roots.itervalues()]
+            while len(stack):
+                node, parent, token, depth = stack.pop()
+                nodes.append((node.used, -depth, node, parent, token))
+                stack.extend((child, node, child_token, depth + 1) for child_token, child in node.children.iteritems())
+            nodes.sort(key=lambda item: item[:2])
+            for used, depth, node, parent, token in nodes:
+                if self.size <= self.max_size * self.EVICT_TO:
+                    break
+                if parent != None and not node.evicted:
+                    del parent.children[token]
+                    self.stats['evictions'] += 1
+                    stack = [node]
+                    while len(stack):
+                        node = stack.pop()
+                        node.evicted = True
+                        self.size -= node.size
+                        stack.extend(node.children.itervalues())
+
 split_tokens_on_chars = ",.?!\"':"
+whitespace_regex = re.compile(r"(\s+)")
+tokenize_cache = LRUCache(4096)
 
 def tokenize(text, spaces_array=None):
     if type(text) == str:
         text = text.decode('utf-8')
-    text = unicodedata.normalize('NFKC', text)
     if spaces_array == None:
       spaces_array = []
+    tokens_and_spaces = tokenize_cache.get(text)
+    if tokens_and_spaces == None:
+        tokens_and_spaces = tokenize_cache[text] = tokenize_uncached(text)
+    tokens, spaces = tokens_and_spaces
+    spaces_array.extend(spaces)
+    return list(tokens)
+
+def tokenize_uncached(text):
+    # returns (tokens, spaces between them) as tuples
+    try:
+        text.encode('ascii')
+    except UnicodeError:
+        # NFKC leaves ascii text unchanged, so only normalize the rest:
+        text = unicodedata.normalize('NFKC', text)
     for c in split_tokens_on_chars:
-        text = text.replace(c, u" {0} ".format(c))
-    text = text.lower()
-    regex = r"\s+"
-    tokens = re.split(regex, text)
-    for space in re.findall(regex, text): spaces_array.append(space)
-    return tokens
+        if c in text:
+            text = text.replace(c, u" {0} ".format(c))
+    # splitting on a captured group yields tokens and the whitespace between them, alternately:
+    parts = whitespace_regex.split(text.lower())
+    return tuple(parts[::2]), tuple(parts[1::2])
 
 def count_runs(items):
     runs = []
@@ -147,9 +314,26 @@ def join_tokens_using_spaces(tokens, spaces):
     text = text.replace(" {0} ".format(c), c)
   return text
 
+class Backtrace(object):
+    # a decoded path, kept as the per-token backpointer tables that lead to `node`,
+    # so that the list of states only has to be built for the winning candidate
+    def __init__(self, backpointers, node, state_for_node):
+        self.backpointers = backpointers
+        self.node = node
+        self.state_for_node = state_for_node
+    
+    def states(self):
+        node = self.node
+        states = []
+        for pointers in reversed(self.backpointers):
+            states.append(self.state_for_node(node))
+            node = pointers[node]
+        states.append(self.state_for_node(node))
+        return states[::-1]
+
 def phrase_from_candidate(candidate, tokens, spaces, tag_processing_functions):
-    log_prob, intent, states = candidate
-    states = states[1:] # strip '$START'
+    log_prob, intent, backtrace = candidate
+    states = backtrace.states()[1:] # strip '$START'
     items = []
     for state, n_tokens in count_runs(states):
         if state[0] == '[':
@@ -164,84 +348,840 @@ def phrase_from_candidate(candidate, tokens, spaces, tag_processing_functions):
         spaces = spaces[n_tokens:]
     return Phrase(intent, items)
 
-def parse_phrase(text, examples, state_regexes=None, supplemental_tags={}, tag_processing_functions={}, weight_first_word=1.5, intent_bonuses={}, allowed_intents=None):
-    if state_regexes == None: state_regexes = {}
-    transition_probs = defaultdict(ProbabilityCounter)
-    emission_probs = defaultdict(ProbabilityCounter)
-    intents = set()
-    states_for_root_states = defaultdict(set)
-    for ex in examples:
-        intents.add(ex.intent)
-        # count transitions:
-        states = map(lambda (token, state): state, ex.token_state_tuples())
-        for state, next_state in zip([u'$START_{0}'.format(ex.intent)] + states, states + ['$END_{0}'.format(ex.intent)]):
-            transition_probs[state.split('/')[0]].add(next_state.split('/')[0])
-            states_for_root_states[state.split('/')[0]].add(state)
-        # count emissions:
-        for item in ex.items_with_intermediate_states():
-            name = item[0]
-            if name[0] != '~':
-                for token in tokenize(item[1]):
-                    emission_probs[name].add(token)
-    for tag, samples in supplemental_tags.iteritems():
-        for sample in samples:
-            for token in tokenize(sample):
-                emission_probs[tag].add(token)
-    def get_emission_prob(state, token):
-        if state[0] == '~':
-            return FREE_TEXT_PROB
-        elif state[0] == '*':
-            # a regex state:
-            # print "does {0} match {1}? {2}".format(token, state[1:], re.match(state_regexes[state[1:]], token))
-            return 1 if re.match(state_regexes[state[1:]], token) else 0
+FREE_TEXT_STATE, REGEX_STATE, INTERMEDIATE_STATE, TAG_STATE = range(4)
+
+class Vocabulary(object):
+    # integer ids for a model's states and tokens. state ids follow the states' sort order (so comparing ids
+    # compares names), and each state's root, kind and intent are worked out once, here
+    def __init__(self, states, tokens):
+        self.states = sorted(states)
+        self.state_ids = dict((state, i) for i, state in enumerate(self.states))
+        self.state_roots = [state.split('/')[0] for state in self.states]
+        self.state_kinds = map(state_kind, self.states)
+        # only intermediate states belong to a single intent:
+        self.state_intents = [state.split(':')[0][1:] if state[0] == '[' else None for state in self.states]
+        self.tokens = list(tokens)
+        self.token_ids = dict((token, i) for i, token in enumerate(self.tokens))
+
+def state_kind(state):
+    if state[0] == '~':
+        return FREE_TEXT_STATE
+    elif state[0] == '*':
+        return REGEX_STATE
+    elif state[0] == '[':
+        return INTERMEDIATE_STATE
+    else:
+        return TAG_STATE
+
+class CompiledModel(object):
+    # an HMM trained once from a list of example `Phrase`s; call `parse` for each incoming text
+    # backend is 'python' or 'numpy' (which runs Viterbi as array operations over all intents at once; requires numpy)
+    # joint=True has the python backend decode all intents in a single lattice instead of one pass per intent; results are identical
+    # beam_width and beam_threshold limit, per intent and token, the candidates kept to the best `beam_width`
+    # and those within `beam_threshold` of the best log-prob (python backend only). a `beam_audit_rate`
+    # fraction of parses is also decoded exactly, and `beam_stats` counts how often the beam changed the answer.
+    # prefix_cache_size keeps up to that many scores and backpointers of Viterbi columns in a PrefixCache, so texts
+    # that start the same way ("what is the ...") share decoding them (python backend). it pays off most with joint=True,
+    # whose columns hold every intent; the per-intent decoder's are small enough that caching them costs about what it saves
+    def __init__(self, examples, state_regexes=None, supplemental_tags={}, backend='python', joint=False, beam_width=None, beam_threshold=None, beam_audit_rate=0.0, prefix_cache_size=None):
+        if state_regexes == None: state_regexes = {}
+        self.state_regexes = state_regexes
+        transition_probs = defaultdict(ProbabilityCounter)
+        emission_probs = defaultdict(ProbabilityCounter)
+        self.intents = set()
+        states_for_root_states = defaultdict(set)
+        for ex in examples:
+            self.intents.add(ex.intent)
+            # count transitions:
+            states = map(lambda (token, state): state, ex.token_state_tuples())
+            for state, next_state in zip([u'$START_{0}'.format(ex.intent)] + states, states + ['$END_{0}'.format(ex.intent)]):
+                transition_probs[state.split('/')[0]].add(next_state.split('/')[0])
+                states_for_root_states[state.split('/')[0]].add(state)
+            # count emissions:
+            for item in ex.items_with_intermediate_states():
+                name = item[0]
+                if name[0] != '~':
+                    for token in tokenize(item[1]):
+                        emission_probs[name].add(token)
+        for tag, samples in supplemental_tags.iteritems():
+            for sample in samples:
+                for token in tokenize(sample):
+                    emission_probs[tag].add(token)
+        self.vocab = vocab = Vocabulary(set(state for states in states_for_root_states.itervalues() for state in states),
+                                        set(token for counter in emission_probs.itervalues() for token in counter.counts))
+        self.unseen_emission_log_prob = smooth_log_prob(0)
+        self.free_text_log_prob = smooth_log_prob(FREE_TEXT_PROB)
+        self.regex_match_log_prob = smooth_log_prob(1)
+        # freeze the counts into smoothed log-probabilities between concrete states, by id, so parsing never touches
+        # the raw counts or state names, or calls math.log:
+        transition_log_probs = dict((root, counter.freeze()) for root, counter in transition_probs.iteritems())
+        self.transitions_from = [[] for state in vocab.states] # state id -> [(next state id, log_prob)]
+        self.end_log_probs = [{} for state in vocab.states] # state id -> {intent: log_prob of ending that intent}
+        for state, root in enumerate(vocab.state_roots):
+            for next_state_root, log_prob in transition_log_probs.get(root, {}).iteritems():
+                if next_state_root.startswith(u'$END_'):
+                    self.end_log_probs[state][next_state_root[len(u'$END_'):]] = log_prob
+                for next_state in states_for_root_states.get(next_state_root, ()):
+                    self.transitions_from[state].append((vocab.state_ids[next_state], log_prob))
+        # state id -> LogProbTable by token id. free text and regex states emit any token with the same log-prob
+        # (regex states' matches are handled separately), so theirs are empty tables with that default:
+        self.emission_log_probs = []
+        for state, kind in zip(vocab.states, vocab.state_kinds):
+            if kind == FREE_TEXT_STATE:
+                self.emission_log_probs.append(LogProbTable({}, self.free_text_log_prob))
+            elif kind == REGEX_STATE or state not in emission_probs:
+                self.emission_log_probs.append(LogProbTable({}, self.unseen_emission_log_prob))
+            else:
+                self.emission_log_probs.append(emission_probs[state].freeze(vocab.token_ids.get))
+        self.regexes_for_states = self.compile_state_regexes()
+        # in sort order, so that ties between intents go to the lowest-sorting one (as they do between states),
+        # however the model was built:
+        self.intents = sorted(self.intents)
+        # each intent's own copy of the transitions between the states it can visit, so decoding it never sees another's.
+        # to build them, split each state's transitions by the intent of the state they lead to (None for shared states):
+        transitions_by_intent = [defaultdict(list) for state in vocab.states]
+        for state, transitions in enumerate(self.transitions_from):
+            for next_state, log_prob in transitions:
+                transitions_by_intent[state][vocab.state_intents[next_state]].append((next_state, log_prob))
+        self.intent_transitions = dict((intent, self.intent_adjacency(intent, transitions_by_intent)) for intent in self.intents)
+        
+        # for cheaply bounding each intent's score: the best emission log-prob any of its states gives each token,
+        # the best it gives an unseen token, and the regexes it can match:
+        self.intent_states = dict((intent, set(transitions)) for intent, transitions in self.intent_transitions.iteritems())
+        self.emission_bounds = defaultdict(dict) # token id -> {intent: log_prob}
+        self.unseen_emission_bounds = {}
+        self.intent_regexes = {}
+        for intent, states in self.intent_states.iteritems():
+            kinds = set(vocab.state_kinds[state] for state in states)
+            self.unseen_emission_bounds[intent] = self.free_text_log_prob if FREE_TEXT_STATE in kinds else self.unseen_emission_log_prob
+            self.intent_regexes[intent] = set(state for state in states if vocab.state_kinds[state] == REGEX_STATE)
+            for state in states:
+                if vocab.state_kinds[state] in (INTERMEDIATE_STATE, TAG_STATE):
+                    for token, log_prob in self.emission_log_probs[state].iteritems():
+                        if log_prob > self.emission_bounds[token].get(intent, self.unseen_emission_bounds[intent]):
+                            self.emission_bounds[token][intent] = log_prob
+        self.configure(backend, joint, beam_width, beam_threshold, beam_audit_rate, prefix_cache_size)
+    
+    # the attributes that `tables` saves, besides the intents, vocab and emissions:
+    table_names = ['state_regexes', 'end_log_probs', 'unseen_emission_log_prob', 'free_text_log_prob',
+                   'regex_match_log_prob', 'intent_transitions', 'unseen_emission_bounds', 'intent_regexes']
+    
+    def tables(self):
+        # everything parsing needs, as plain types that marshal can write; see `from_tables`
+        tables = dict((name, getattr(self, name)) for name in self.table_names)
+        tables.update(intents=self.intents, states=self.vocab.states, tokens=self.vocab.tokens, emission_bounds=dict(self.emission_bounds),
+                      emission_log_probs=[(dict(log_probs), log_probs.default) for log_probs in self.emission_log_probs])
+        return tables
+    
+    @classmethod
+    def from_tables(cls, tables, backend='python', joint=False, beam_width=None, beam_threshold=None, beam_audit_rate=0.0, prefix_cache_size=None):
+        # the model that `tables()` was called on, without re-counting the examples
+        model = cls.__new__(cls)
+        for name in cls.table_names:
+            setattr(model, name, tables[name])
+        model.intents = list(tables['intents'])
+        model.vocab = Vocabulary(tables['states'], tables['tokens'])
+        model.intent_states = dict((intent, set(transitions)) for intent, transitions in model.intent_transitions.iteritems())
+        model.emission_bounds = defaultdict(dict, tables['emission_bounds'])
+        model.emission_log_probs = [LogProbTable(log_probs, default) for log_probs, default in tables['emission_log_probs']]
+        model.regexes_for_states = model.compile_state_regexes()
+        model.configure(backend, joint, beam_width, beam_threshold, beam_audit_rate, prefix_cache_size)
+        return model
+    
+    def compile_state_regexes(self):
+        # regex states' patterns, compiled once
+        return dict((state, re.compile(self.state_regexes[name[1:]])) for state, name in enumerate(self.vocab.states) if self.vocab.state_kinds[state] == REGEX_STATE)
+    
+    def configure(self, backend, joint, beam_width, beam_threshold, beam_audit_rate, prefix_cache_size=None):
+        self.joint = joint
+        self.beam_width = beam_width
+        self.beam_threshold = beam_threshold
+        self.beam_audit_rate = beam_audit_rate
+        self.beam_stats = {'parses': 0, 'audited': 0, 'changed': 0}
+        self.prefix_cache = PrefixCache(prefix_cache_size) if prefix_cache_size else None
+        self.backend = backend
+        if backend == 'numpy':
+            if numpy is None:
+                raise ValueError("the 'numpy' backend requires numpy")
+            if self.uses_beam():
+                raise ValueError("beam search is only supported by the 'python' backend")
+            self.numpy_decoder = NumpyDecoder(self)
+        elif backend != 'python':
+            raise ValueError("unknown backend: {0}".format(backend))
+    
+    def intent_adjacency(self, intent, transitions_by_intent):
+        # state id -> [(next state id, log_prob)] for the states a decode of `intent` can visit: everything reachable
+        # from $START_<intent>, minus other intents' intermediate states (and the transitions into them)
+        start = self.vocab.state_ids[u'$START_{0}'.format(intent)]
+        adjacency = {}
+        frontier = [start]
+        while len(frontier):
+            state = frontier.pop()
+            if state in adjacency:
+                continue
+            adjacency[state] = transitions_by_intent[state].get(None, []) + transitions_by_intent[state].get(intent, [])
+            frontier.extend(next_state for next_state, _ in adjacency[state] if next_state not in adjacency)
+        return adjacency
+    
+    def regex_matches(self, tokens):
+        # for each token, the set of regex states that match it; each distinct token is tested once
+        matches_for_tokens = {}
+        for token in tokens:
+            if token not in matches_for_tokens:
+                matches_for_tokens[token] = frozenset(state for state, regex in self.regexes_for_states.iteritems() if regex.match(token))
+        return [matches_for_tokens[token] for token in tokens]
+    
+    def emission_log_prob(self, state, token_id, matching_regex_states):
+        # `token_id` is None for tokens the model has never seen; `matching_regex_states` only holds regex states
+        if state in matching_regex_states:
+            return self.regex_match_log_prob
+        log_probs = self.emission_log_probs[state]
+        return log_probs.get(token_id, log_probs.default)
+    
+    def uses_beam(self):
+        return self.beam_width != None or self.beam_threshold != None
+    
+    def prune_to_beam(self, scores):
+        # keeps each intent's best `beam_width` nodes, and those within `beam_threshold` of its best
+        scored_for_intents = defaultdict(list)
+        for node, log_prob in scores.iteritems():
+            scored_for_intents[node[0]].append((log_prob, node))
+        pruned = {}
+        for scored in scored_for_intents.itervalues():
+            scored.sort(reverse=True)
+            if self.beam_width != None:
+                scored = scored[:self.beam_width]
+            if self.beam_threshold != None:
+                scored = [(log_prob, node) for log_prob, node in scored if log_prob >= scored[0][0] - self.beam_threshold]
+            for log_prob, node in scored:
+                pruned[node] = log_prob
+        return pruned
+    
+    def decode_joint(self, intents, tokens, weight_first_word=1.5, beam=False, regex_matches=None, floors=None):
+        # decodes one lattice over all `intents` at once. its nodes are (intent, state) pairs, so each intent
+        # scores exactly as it would alone, but each state's emission is computed once per token for all intents.
+        # returns the best (log_prob, intent, Backtrace) candidate for each intent that can produce `tokens`
+        # `floors` maps intents to a log-prob below which their nodes are dropped (see bounded_candidate)
+        if regex_matches == None: regex_matches = self.regex_matches(tokens)
+        scores = self.start_scores(intents)
+        backpointers = []
+        # decodes resume from, and add to, the prefix cache: a column depends only on the tokens so far, the intents,
+        # weight_first_word and whether the beam pruned it. the bounded decoder's floors only ever drop nodes that can't
+        # win, so a column pruned at a lower floor than ours holds every node we'd keep, with the same scores and
+        # backpointers (each node's best previous node scores at least as well as it does)
+        prefix_cache = self.prefix_cache if len(intents) == 1 or not floors else None
+        resumed = 0
+        if prefix_cache:
+            key = (tuple(intents), beam)
+            floor = floors.get(intents[0], float('-inf')) if floors else float('-inf')
+            prefixes = prefix_cache.prefixes(weight_first_word, tokens)
+            path = prefix_cache.resume(prefixes, key, len(tokens), floor)
+            if len(path):
+                cached_scores, pointers, cached_floor = path[-1]
+                scores = dict((node, log_prob) for node, log_prob in cached_scores.iteritems() if log_prob >= floor) if cached_floor < floor else cached_scores
+                backpointers = [pointers for cached_scores, pointers, cached_floor in path]
+                resumed = len(path)
+        for i in xrange(resumed, len(tokens)):
+            scores, pointers = self.next_column(scores, tokens[i], regex_matches[i], weight_first_word if i == 0 else 1, beam, floors)
+            backpointers.append(pointers)
+            if prefix_cache and i < len(prefixes):
+                prefix_cache.store(prefixes[i], key, scores, pointers, floor)
+        if prefix_cache and prefix_cache.size > prefix_cache.max_size:
+            prefix_cache.evict()
+        return self.end_candidates(intents, scores, backpointers)
+    
+    def start_scores(self, intents):
+        # the lattice's scores before any tokens: each intent's $START node
+        return dict(((intent, self.vocab.state_ids[u'$START_{0}'.format(intent)]), 0.0) for intent in intents)
+    
+    def next_column(self, scores, token, matching_regex_states, weight=1, beam=False, floors=None):
+        # one Viterbi step: the (scores, backpointers) after `token`, from the `scores` before it. 'scores' map nodes to
+        # log_probs, and backpointers map nodes to the previous node; ties go to the lowest-sorting previous state
+        # (the lowest id). `weight` multiplies the new log-probs (it's weight_first_word for the first token)
+        token_id = self.vocab.token_ids.get(token)
+        emission_log_probs = {}
+        next_scores = {}
+        pointers = {}
+        for node, log_prob in scores.iteritems():
+            intent, state = node
+            for next_state, transition_log_prob in self.intent_transitions[intent][state]:
+                if next_state not in emission_log_probs:
+                    emission_log_probs[next_state] = self.emission_log_prob(next_state, token_id, matching_regex_states)
+                new_log_prob = log_prob + transition_log_prob + emission_log_probs[next_state]
+                next_node = (intent, next_state)
+                best = next_scores.get(next_node)
+                if best == None or new_log_prob > best or (new_log_prob == best and state < pointers[next_node][1]):
+                    next_scores[next_node] = new_log_prob
+                    pointers[next_node] = node
+        scores = next_scores
+        if weight != 1:
+            scores = dict((node, log_prob * weight) for node, log_prob in scores.iteritems())
+        if beam:
+            scores = self.prune_to_beam(scores)
+        if floors:
+            scores = dict((node, log_prob) for node, log_prob in scores.iteritems() if log_prob >= floors.get(node[0], log_prob))
+        return scores, pointers
+    
+    def end_candidates(self, intents, scores, backpointers):
+        # the best (log_prob, intent, Backtrace) candidate for each of `intents` that can end after the last column
+        best_ends_for_intents = {}
+        for node, log_prob in scores.iteritems():
+            intent, state = node
+            if intent in self.end_log_probs[state]:
+                new_log_prob = log_prob + self.end_log_probs[state][intent]
+                best = best_ends_for_intents.get(intent)
+                if best == None or new_log_prob > best[0] or (new_log_prob == best[0] and state < best[1][1]):
+                    best_ends_for_intents[intent] = (new_log_prob, node)
+        state_for_node = lambda node: self.vocab.states[node[1]]
+        return [(best_ends_for_intents[intent][0], intent, Backtrace(backpointers, best_ends_for_intents[intent][1], state_for_node)) for intent in intents if intent in best_ends_for_intents]
+    
+    def decode_intent(self, intent, tokens, weight_first_word=1.5, beam=False, regex_matches=None):
+        # runs Viterbi for one intent; returns the best (log_prob, intent, Backtrace) candidate, or None
+        candidates = self.decode_joint([intent], tokens, weight_first_word, beam, regex_matches)
+        return candidates[0] if len(candidates) else None
+    
+    def decode(self, intents, tokens, weight_first_word=1.5, exact=False, regex_matches=None):
+        # the best candidate for each intent that can produce `tokens`; exact=True ignores the beam
+        if regex_matches == None: regex_matches = self.regex_matches(tokens)
+        beam = self.uses_beam() and not exact
+        if self.backend == 'numpy':
+            candidates = self.numpy_decoder.decode(intents, tokens, weight_first_word, regex_matches)
+        elif self.joint:
+            candidates = self.decode_joint(intents, tokens, weight_first_word, beam, regex_matches)
         else:
-            return emission_probs[next_state][token]
-    best_candidate = None
-    # 'candidates' are (log_prob, intent, [state]) tuples
-    spaces = []
-    tokens = tokenize(text, spaces)
-    
-    if allowed_intents:
-        intents = [i for i in intents if i in allowed_intents]
-    
-    for intent in intents:
-        # print 'INTENT {0}'.format(intent)
-        candidates = [(0.0, intent, [u'$START_{0}'.format(intent)])]
-        for i, token in enumerate(tokens + [None]):
-            # if intent == 'search': print candidates
-            best_candidates_for_last_state = {}
-            for (candidate_log_prob, candidate_intent, candidate_states) in candidates:
-                state = candidate_states[-1].split('/')[0]
-                for next_state_root, transition_prob in transition_probs[state].iteritems():
-                    new_candidate = None
-                    if token == None: 
-                        if next_state_root == u"$END_{0}".format(intent):
-                            # print state, next_state_root, transition_prob
-                            new_candidate = (candidate_log_prob + smooth_log_prob(transition_prob), candidate_intent, candidate_states)
-                            if next_state_root not in best_candidates_for_last_state or new_candidate[0] > best_candidates_for_last_state[next_state_root][0]:
-                                best_candidates_for_last_state[next_state_root] = new_candidate
-                    else:
-                        for next_state in states_for_root_states[next_state_root]:
-                            if next_state[0]=='[':
-                                state_intent = next_state.split(':')[0][1:]
-                                if state_intent != intent:
-                                    continue
-                            emission_prob = get_emission_prob(next_state, token)
-                            new_candidate = (candidate_log_prob + smooth_log_prob(transition_prob) + smooth_log_prob(emission_prob), candidate_intent, candidate_states + [next_state])
-                            if next_state not in best_candidates_for_last_state or new_candidate[0] > best_candidates_for_last_state[next_state][0]:
-                                best_candidates_for_last_state[next_state] = new_candidate
-            candidates = best_candidates_for_last_state.values()
-            if i == 0:
-              candidates = [(prob * weight_first_word, intent, states) for (prob, intent, states) in candidates]
-        #print candidates
+            candidates = (self.decode_intent(intent, tokens, weight_first_word, beam, regex_matches) for intent in intents)
+        return [candidate for candidate in candidates if candidate]
+    
+    def decode_many(self, keys, regex_matches, exact=False):
+        # decodes several (tokens, intents, weight_first_word) keys; returns a list of candidate lists.
+        # the numpy backend decodes keys with the same intents and number of tokens as one batch
+        if self.backend != 'numpy':
+            return [self.decode(list(intents), list(tokens), weight_first_word, exact, matches) for (tokens, intents, weight_first_word), matches in zip(keys, regex_matches)]
+        batches = defaultdict(list)
+        for index, (tokens, intents, weight_first_word) in enumerate(keys):
+            batches[(intents, len(tokens), weight_first_word)].append(index)
+        decoded = [None] * len(keys)
+        for (intents, n_tokens, weight_first_word), indices in batches.iteritems():
+            batch = self.numpy_decoder.decode_batch(list(intents), [keys[i][0] for i in indices], weight_first_word, [regex_matches[i] for i in indices])
+            for index, candidates in zip(indices, batch):
+                decoded[index] = [candidate for candidate in candidates if candidate]
+        return decoded
+    
+    def best_candidate(self, intents, tokens, intent_bonuses={}, weight_first_word=1.5, exact=False, regex_matches=None):
+        return best_adjusted_candidate(self.decode(intents, tokens, weight_first_word, exact, regex_matches), intent_bonuses)
+    
+    def bounded_candidate(self, intents, tokens, intent_bonuses={}, weight_first_word=1.5, beam=False, regex_matches=None):
+        # best_candidate for the python per-intent decoder, by branch and bound: intents are decoded one at a time,
+        # those with the highest upper bounds (see intent_upper_bounds; they favor intents with big bonuses) first.
+        # every transition, emission and end log-prob is negative, so once the first word's weight is applied a node's
+        # log-prob only falls, and as bonuses are positive divisors, a node whose log-prob divided by its intent's bonus is
+        # below the best finished candidate can't win. such nodes are dropped, and intents whose bound is below it skipped.
+        # the result is the same as best_candidate's, ties included
+        if regex_matches == None: regex_matches = self.regex_matches(tokens)
+        bounds = self.intent_upper_bounds(intents, tokens, intent_bonuses, weight_first_word, regex_matches)
+        positions = dict((intent, i) for i, intent in enumerate(intents)) # ties go to the earliest intent, as in best_candidate
+        best_candidate = None
+        for intent in sorted(intents, key=lambda intent: bounds[intent], reverse=True):
+            # a little slack on the bounds, for rounding:
+            if best_candidate and bounds[intent] < best_candidate[0] * (1 + BOUND_SLACK):
+                break # the rest are sorted below it
+            bonus = intent_bonuses.get(intent, 1)
+            floors = {intent: best_candidate[0] * bonus * (1 + BOUND_SLACK)} if best_candidate else None
+            for prob, intent, states in self.decode_joint([intent], tokens, weight_first_word, beam, regex_matches, floors):
+                prob /= bonus
+                if best_candidate == None or prob > best_candidate[0] or (prob == best_candidate[0] and positions[intent] < positions[best_candidate[1]]):
+                    best_candidate = (prob, intent, states)
+        return best_candidate
+    
+    def intent_upper_bounds(self, intents, tokens, intent_bonuses={}, weight_first_word=1.5, regex_matches=None):
+        # an upper bound on each intent's bonus-adjusted score, ignoring transitions (whose log-probs are <= 0)
+        if regex_matches == None: regex_matches = self.regex_matches(tokens)
+        token_bounds = [self.emission_bounds.get(self.vocab.token_ids.get(token), {}) for token in tokens]
+        bounds = {}
+        for intent in intents:
+            bound = 0.0
+            for i, token in enumerate(tokens):
+                token_bound = token_bounds[i].get(intent, self.unseen_emission_bounds[intent])
+                if len(regex_matches[i]) and not self.intent_regexes[intent].isdisjoint(regex_matches[i]):
+                    token_bound = max(token_bound, self.regex_match_log_prob)
+                bound += token_bound
+                if i == 0:
+                    bound *= weight_first_word
+            bounds[intent] = bound / intent_bonuses.get(intent, 1)
+        return bounds
+    
+    def likely_intents(self, intents, tokens, intent_bonuses={}, weight_first_word=1.5, top_k=None, margin=None, regex_matches=None):
+        # the `top_k` intents with the highest upper bounds, and/or those within `margin` of the highest
+        bounds = self.intent_upper_bounds(intents, tokens, intent_bonuses, weight_first_word, regex_matches)
+        intents = sorted(intents, key=lambda intent: bounds[intent], reverse=True)
+        if top_k != None:
+            intents = intents[:top_k]
+        if margin != None and len(intents):
+            intents = [intent for intent in intents if bounds[intent] >= bounds[intents[0]] - margin]
+        return intents
+    
+    def parse(self, text, intent_bonuses={}, allowed_intents=None, tag_processing_functions={}, weight_first_word=1.5, top_k=None, margin=None, exact=False, bound=False):
+        # `top_k` and `margin` restrict the full decode to the intents that score best on a cheap upper bound
+        # (see `likely_intents`); exact=True ignores them and the beam, and searches every intent.
+        # bound=True finds the same parse by branch and bound (see bounded_candidate); it only applies to the
+        # python backend's per-intent decoder, and is ignored otherwise
+        return self.parse_many([text], intent_bonuses, allowed_intents, tag_processing_functions, weight_first_word, top_k, margin, exact, bound=bound)[0]
+    
+    def parse_many(self, texts, intent_bonuses={}, allowed_intents=None, tag_processing_functions={}, weight_first_word=1.5, top_k=None, margin=None, exact=False, decoded=None, bound=False):
+        # parses several texts with the same options, returning what `parse` would for each.
+        # each distinct text is tokenized and decoded once. `decoded` caches candidates by (tokens, intents, weight_first_word):
+        # pass the same dict to calls with different bonuses to share the decoding between them.
+        # a bounded decode depends on the bonuses, so with bound=True nothing goes in `decoded`
+        # 'candidates' are (log_prob, intent, Backtrace) tuples
+        if decoded == None: decoded = {}
+        intents = self.intents
+        if allowed_intents:
+            intents = [i for i in intents if i in allowed_intents]
+        beam = self.uses_beam() and not exact
         
-        def apply_intent_bonuses(candidate):
-            prob, intent, states = candidate
-            prob /= intent_bonuses.get(candidate[1], 1)
-            return prob, intent, states
-        candidates = map(apply_intent_bonuses, candidates)
+        inputs = {} # text -> (tokens, spaces, regex matches, decode key)
+        for text in texts:
+            if text not in inputs:
+                spaces = []
+                tokens = tokenize(text, spaces)
+                regex_matches = self.regex_matches(tokens)
+                text_intents = intents
+                if not exact and (top_k != None or margin != None):
+                    text_intents = self.likely_intents(intents, tokens, intent_bonuses, weight_first_word, top_k, margin, regex_matches)
+                inputs[text] = (tokens, spaces, regex_matches, (tuple(tokens), tuple(text_intents), weight_first_word))
         
-        for candidate in candidates:
-            if best_candidate == None or candidate[0] > best_candidate[0]:
-                best_candidate = candidate
-    return phrase_from_candidate(best_candidate, tokens, spaces, tag_processing_functions) if best_candidate else None
+        best_candidates = {}
+        if bound and self.backend == 'python' and not self.joint:
+            for text, (tokens, spaces, regex_matches, key) in inputs.iteritems():
+                best_candidates[text] = self.bounded_candidate(list(key[1]), tokens, intent_bonuses, weight_first_word, beam, regex_matches)
+        else:
+            cache = decoded.setdefault(beam, {}) # beam-pruned and exact candidates differ
+            undecoded = dict((key, regex_matches) for tokens, spaces, regex_matches, key in inputs.itervalues() if key not in cache)
+            keys = undecoded.keys()
+            cache.update(zip(keys, self.decode_many(keys, [undecoded[key] for key in keys], exact)))
+            for text, (tokens, spaces, regex_matches, key) in inputs.iteritems():
+                best_candidates[text] = best_adjusted_candidate(cache[key], intent_bonuses)
+        
+        for text, (tokens, spaces, regex_matches, key) in inputs.iteritems():
+            if beam:
+                self.audit_beam(key[1], tokens, intent_bonuses, weight_first_word, regex_matches, best_candidates[text])
+        phrases = []
+        for text in texts:
+            tokens, spaces, regex_matches, key = inputs[text]
+            phrases.append(phrase_from_candidate(best_candidates[text], tokens, spaces, tag_processing_functions) if best_candidates[text] else None)
+        return phrases
+    
+    def audit_beam(self, intents, tokens, intent_bonuses, weight_first_word, regex_matches, best_candidate):
+        # counts beam-pruned decodes, and re-decodes `beam_audit_rate` of them exactly to count how often the beam changed the result
+        self.beam_stats['parses'] += 1
+        if random.random() < self.beam_audit_rate:
+            exact_candidate = self.best_candidate(intents, tokens, intent_bonuses, weight_first_word, True, regex_matches)
+            self.beam_stats['audited'] += 1
+            if (exact_candidate and (exact_candidate[1], exact_candidate[2].states())) != (best_candidate and (best_candidate[1], best_candidate[2].states())):
+                self.beam_stats['changed'] += 1
+
+def best_adjusted_candidate(candidates, intent_bonuses):
+    # the candidate with the highest log_prob after dividing by its intent's bonus
+    best_candidate = None
+    for prob, intent, states in candidates:
+        prob /= intent_bonuses.get(intent, 1)
+        if best_candidate == None or prob > best_candidate[0]:
+            best_candidate = (prob, intent, states)
+    return best_candidate
+
+class ParseSession(object):
+    # parses a text as it's typed: `feed` appends to it, `backspace` deletes from its end, and `best` is the Phrase that
+    # `model.parse` would give the text so far. the Viterbi column after each token is kept, so an edit only decodes
+    # the tokens from the first one it changed (usually just the last). it decodes all the allowed intents as one
+    # lattice with the python decoder, whatever the model's backend; `tokens_decoded` counts the columns it has decoded
+    def __init__(self, model, text=u"", intent_bonuses={}, allowed_intents=None, tag_processing_functions={}, weight_first_word=1.5):
+        self.model = model
+        self.intents = model.intents
+        if allowed_intents:
+            self.intents = [i for i in self.intents if i in allowed_intents]
+        self.intent_bonuses = intent_bonuses
+        self.tag_processing_functions = tag_processing_functions
+        self.weight_first_word = weight_first_word
+        self.beam = model.uses_beam()
+        self.start = model.start_scores(self.intents)
+        self.text = u""
+        self.tokens = []
+        self.spaces = []
+        self.columns = [] # (scores, backpointers) after each token
+        self.tokens_decoded = 0
+        self.set_text(text)
+    
+    def feed(self, text_delta):
+        self.set_text(self.text + text_delta)
+    
+    def backspace(self, n_chars=1):
+        self.set_text(self.text[:max(0, len(self.text) - n_chars)])
+    
+    def set_text(self, text):
+        # keeps the columns of the tokens `text` starts with in common with the current text, and decodes the rest
+        spaces = []
+        tokens = tokenize(text, spaces)
+        shared = 0
+        while shared < min(len(tokens), len(self.tokens)) and tokens[shared] == self.tokens[shared]:
+            shared += 1
+        del self.columns[shared:]
+        scores = self.columns[-1][0] if shared else self.start
+        for token, matching_regex_states in zip(tokens[shared:], self.model.regex_matches(tokens[shared:])):
+            weight = self.weight_first_word if len(self.columns) == 0 else 1
+            scores, pointers = self.model.next_column(scores, token, matching_regex_states, weight, self.beam)
+            self.columns.append((scores, pointers))
+        self.tokens_decoded += len(tokens) - shared
+        self.text, self.tokens, self.spaces = text, tokens, spaces
+    
+    def best(self):
+        scores = self.columns[-1][0] if len(self.columns) else self.start
+        candidates = self.model.end_candidates(self.intents, scores, [pointers for scores, pointers in self.columns])
+        candidate = best_adjusted_candidate(candidates, self.intent_bonuses)
+        return phrase_from_candidate(candidate, self.tokens, self.spaces, self.tag_processing_functions) if candidate else None
+
+def filled_array(shape, value, dtype=float):
+    a = numpy.empty(shape, dtype=dtype)
+    a.fill(value)
+    return a
+
+class Lattice(object):
+    # transitions between integer nodes, as arrays sorted by destination node.
+    # each node stands for a state (`node_states`) within one intent's decode
+    def __init__(self, node_states, starts, sources, destinations, log_probs, end_nodes, end_log_probs):
+        self.node_states = numpy.asarray(node_states, dtype=int)
+        self.starts = numpy.asarray(starts, dtype=int)
+        # within a destination, order transitions by source state, so that ties go to the lowest-sorting state:
+        order = numpy.lexsort((self.node_states[numpy.asarray(sources, dtype=int)], numpy.asarray(destinations)))
+        self.sources = numpy.asarray(sources, dtype=int)[order]
+        self.log_probs = numpy.asarray(log_probs, dtype=float)[order]
+        destinations = numpy.asarray(destinations, dtype=int)[order]
+        # transitions into the same node are contiguous; `groups` maps each transition to its destination's slot:
+        self.destinations, self.group_starts = numpy.unique(destinations, return_index=True)
+        self.groups = numpy.cumsum(numpy.r_[0, destinations[1:] != destinations[:-1]]) if len(destinations) else destinations
+        self.destination_states = self.node_states[self.destinations]
+        self.end_nodes = numpy.asarray(end_nodes, dtype=int)
+        self.end_log_probs = numpy.asarray(end_log_probs, dtype=float)
+        self.shared = False
+
+class NumpyDecoder(object):
+    # runs Viterbi over a `CompiledModel` as max/argmax array steps over integer state indices.
+    # transitions are kept as sparse (source, destination, log_prob) arrays,
+    # and emissions as a sparse token-id x state matrix (CSR)
+    def __init__(self, model):
+        self.model = model
+        vocab = model.vocab
+        self.states = vocab.states
+        self.end_transitions = defaultdict(list) # intent -> [(state id, log_prob)]
+        for state, end_log_probs in enumerate(model.end_log_probs):
+            for intent, log_prob in end_log_probs.iteritems():
+                self.end_transitions[intent].append((state, log_prob))
+        self.intent_lattices = {}
+        self.joint_lattices = {}
+        self.shared_region = None # see `share`
+        
+        # emissions: a default row (free text or unseen), overridden per-token by a sparse matrix:
+        self.default_emissions = numpy.array([model.free_text_log_prob if kind == FREE_TEXT_STATE else model.unseen_emission_log_prob for kind in vocab.state_kinds])
+        emissions_for_tokens = [[] for token in vocab.tokens]
+        for state, log_probs_for_tokens in enumerate(model.emission_log_probs):
+            if vocab.state_kinds[state] in (INTERMEDIATE_STATE, TAG_STATE):
+                for token_id, emission_log_prob in log_probs_for_tokens.iteritems():
+                    emissions_for_tokens[token_id].append((state, emission_log_prob))
+        indptr, indices, data = [0], [], []
+        for entries in emissions_for_tokens:
+            for state, emission_log_prob in entries:
+                indices.append(state)
+                data.append(emission_log_prob)
+            indptr.append(len(indices))
+        self.emission_indptr = numpy.array(indptr, dtype=int)
+        self.emission_indices = numpy.array(indices, dtype=int)
+        self.emission_data = numpy.array(data, dtype=float)
+    
+    def lattice_for_intent(self, intent):
+        # nodes are the states reachable from $START_<intent>, skipping other intents' intermediate states
+        if intent not in self.intent_lattices:
+            start = self.model.vocab.state_ids[u'$START_{0}'.format(intent)]
+            node_states = [start]
+            nodes = {start: 0}
+            sources, destinations, log_probs = [], [], []
+            for node, state in enumerate(node_states): # grows as we go
+                for next_state, transition_log_prob in self.model.intent_transitions[intent][state]:
+                    if next_state not in nodes:
+                        nodes[next_state] = len(node_states)
+                        node_states.append(next_state)
+                    sources.append(node)
+                    destinations.append(nodes[next_state])
+                    log_probs.append(transition_log_prob)
+            end_transitions = [(nodes[state], log_prob) for state, log_prob in self.end_transitions[intent] if state in nodes]
+            self.intent_lattices[intent] = Lattice(node_states, [0], sources, destinations, log_probs, [n for n, _ in end_transitions], [lp for _, lp in end_transitions])
+        return self.intent_lattices[intent]
+    
+    def joint_lattice(self, intents):
+        # the disjoint union of several intents' lattices, so they can all be decoded in one pass.
+        # `end_groups` are the offsets of each intent's end nodes
+        key = frozenset(intents)
+        if key not in self.joint_lattices:
+            if len(self.joint_lattices) >= 32:
+                # keep the lattices that live in the shared region:
+                self.joint_lattices = dict((k, lattice) for k, lattice in self.joint_lattices.iteritems() if lattice.shared)
+            intents = sorted(intents)
+            parts = [self.lattice_for_intent(intent) for intent in intents]
+            offsets = numpy.cumsum([0] + [len(part.node_states) for part in parts])
+            lattice = Lattice(numpy.concatenate([part.node_states for part in parts]),
+                              [offset + part.starts[0] for part, offset in zip(parts, offsets)],
+                              numpy.concatenate([part.sources + offset for part, offset in zip(parts, offsets)]),
+                              numpy.concatenate([part.destinations[part.groups] + offset for part, offset in zip(parts, offsets)]),
+                              numpy.concatenate([part.log_probs for part in parts]),
+                              numpy.concatenate([part.end_nodes + offset for part, offset in zip(parts, offsets)]),
+                              numpy.concatenate([part.end_log_probs for part in parts]))
+            lattice.intents = intents
+            lattice.end_groups = numpy.cumsum([0] + [len(part.end_nodes) for part in parts])
+            self.joint_lattices[key] = lattice
+        return self.joint_lattices[key]
+    
+    def share(self):
+        # builds every lattice up front, and moves all the arrays into one anonymous shared memory map, so that
+        # processes forked afterwards read the same pages instead of each building (or copy-on-writing) their own
+        if self.shared_region:
+            return
+        lattices = [self.lattice_for_intent(intent) for intent in self.model.intents] + [self.joint_lattice(self.model.intents)]
+        owners = [self] + lattices
+        arrays = [(owner, name) for owner in owners for name, value in sorted(vars(owner).iteritems()) if isinstance(value, numpy.ndarray)]
+        self.shared_region, copies = shared_copies([getattr(owner, name) for owner, name in arrays])
+        for (owner, name), array in zip(arrays, copies):
+            setattr(owner, name, array)
+        for lattice in lattices:
+            lattice.shared = True
+    
+    def emission_row(self, token, matching_regex_states):
+        row = self.default_emissions.copy()
+        token_id = self.model.vocab.token_ids.get(token)
+        if token_id != None:
+            start, end = self.emission_indptr[token_id], self.emission_indptr[token_id+1]
+            row[self.emission_indices[start:end]] = self.emission_data[start:end]
+        if len(matching_regex_states):
+            row[list(matching_regex_states)] = self.model.regex_match_log_prob
+        return row
+    
+    def decode(self, intents, tokens, weight_first_word=1.5, regex_matches=None):
+        # the best (log_prob, intent, Backtrace) candidate, or None, for each intent
+        if regex_matches == None: regex_matches = self.model.regex_matches(tokens)
+        return self.decode_batch(intents, [tokens], weight_first_word, [regex_matches])[0]
+    
+    def decode_batch(self, intents, token_lists, weight_first_word=1.5, regex_matches=None):
+        # decodes several token lists of the same length at once: each token's emissions are a (batch x state) matrix.
+        # all the intents are decoded in one pass over their joint lattice, since a pass per intent costs more in
+        # per-step numpy overhead than it saves. returns a list of candidates (as `decode` would) per token list
+        if regex_matches == None: regex_matches = [self.model.regex_matches(tokens) for tokens in token_lists]
+        emission_rows = [numpy.array([self.emission_row(tokens[i], matches[i]) for tokens, matches in zip(token_lists, regex_matches)]) for i in xrange(len(token_lists[0]))]
+        return self.decode_joint(intents, emission_rows, weight_first_word, len(token_lists))
+    
+    def viterbi(self, lattice, emission_rows, weight_first_word, batch_size):
+        # returns the scores of the end transitions, and a backpointer array for each token; both have a row per batch item
+        shape = (batch_size, len(lattice.node_states))
+        scores = filled_array(shape, float('-inf'))
+        scores[:, lattice.starts] = 0.0
+        transition_indices = numpy.arange(len(lattice.sources))
+        backpointers = []
+        for i, emissions in enumerate(emission_rows):
+            candidate_scores = scores[:, lattice.sources] + lattice.log_probs
+            best_scores = numpy.maximum.reduceat(candidate_scores, lattice.group_starts, axis=1)
+            # the first transition into each node that achieves its best score:
+            best_transitions = numpy.where(candidate_scores == best_scores[:, lattice.groups], transition_indices, len(transition_indices))
+            best_transitions = numpy.minimum.reduceat(best_transitions, lattice.group_starts, axis=1)
+            pointers = filled_array(shape, -1, dtype=int)
+            pointers[:, lattice.destinations] = lattice.sources[best_transitions]
+            backpointers.append(pointers)
+            scores = filled_array(shape, float('-inf'))
+            scores[:, lattice.destinations] = best_scores + emissions[:, lattice.destination_states]
+            if i == 0:
+                scores *= weight_first_word
+        return scores[:, lattice.end_nodes] + lattice.end_log_probs, backpointers
+    
+    def candidate(self, lattice, intent, end, final_scores, backpointers):
+        # `final_scores` and `backpointers` are for a single batch item
+        if final_scores[end] == float('-inf'):
+            return None
+        return (float(final_scores[end]), intent, Backtrace(backpointers, lattice.end_nodes[end], lambda node: self.states[lattice.node_states[node]]))
+    
+    def decode_joint(self, intents, emission_rows, weight_first_word, batch_size):
+        # a list of candidates per batch item
+        lattice = self.joint_lattice(intents)
+        if len(lattice.sources) == 0:
+            return [[] for b in xrange(batch_size)]
+        final_scores, backpointers = self.viterbi(lattice, emission_rows, weight_first_word, batch_size)
+        batch = []
+        for b in xrange(batch_size):
+            item_backpointers = [pointers[b] for pointers in backpointers]
+            candidates = {}
+            for intent, start, end in zip(lattice.intents, lattice.end_groups[:-1], lattice.end_groups[1:]):
+                if end > start:
+                    candidates[intent] = self.candidate(lattice, intent, start + numpy.argmax(final_scores[b, start:end]), final_scores[b], item_backpointers)
+            batch.append([candidates.get(intent) for intent in intents])
+        return batch
+
+def shared_copies(arrays):
+    # read-only copies of `arrays` in one anonymous shared mmap; returns (the mmap, [copy])
+    offsets = []
+    size = 0
+    for array in arrays:
+        size += -size % 16 # keep every copy aligned
+        offsets.append(size)
+        size += array.nbytes
+    region = mmap.mmap(-1, max(size, 1))
+    copies = []
+    for array, offset in zip(arrays, offsets):
+        shared = numpy.frombuffer(region, dtype=array.dtype, count=array.size, offset=offset).reshape(array.shape)
+        shared[...] = array
+        shared.flags.writeable = False
+        copies.append(shared)
+    return region, copies
+
+class ParsePool(object):
+    # parses on `processes` forked worker processes, which share the model's arrays read-only (see `NumpyDecoder.share`).
+    # requests and results go over queues; `parse` and `parse_many` can be called from several threads at once.
+    # the workers' beam_stats and prefix cache stats aren't reported back. if a worker dies (killed, or crashed), its
+    # request is never answered, so every pending and later request fails with a RuntimeError instead
+    WORKER_CHECK_INTERVAL = 1.0 # seconds between checks that the workers are alive
+    
+    def __init__(self, model, processes=None, tag_processing_functions={}):
+        if model.backend != 'numpy':
+            raise ValueError("a ParsePool needs a model with the numpy backend")
+        model.numpy_decoder.share()
+        self.requests = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.workers = [multiprocessing.Process(target=parse_worker, args=(model, tag_processing_functions, self.requests, self.results)) for i in xrange(processes or multiprocessing.cpu_count())]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+        # started after forking, since forking copies only the forking thread:
+        self.pending = {} # request id -> [threading.Event, result, error]
+        self.error = None # set once a worker has died
+        self.lock = threading.Lock()
+        self.request_ids = itertools.count()
+        self.collector = threading.Thread(target=self.collect_results)
+        self.collector.daemon = True
+        self.collector.start()
+    
+    def collect_results(self):
+        # checks the workers every WORKER_CHECK_INTERVAL, whether or not results are still arriving from the live ones
+        next_check = time.time() + self.WORKER_CHECK_INTERVAL
+        while True:
+            try:
+                result = self.results.get(timeout=max(0, next_check - time.time()))
+            except Queue.Empty:
+                result = False
+            if time.time() >= next_check:
+                self.check_workers()
+                next_check = time.time() + self.WORKER_CHECK_INTERVAL
+            if result == False:
+                continue
+            if result == None:
+                break
+            request_id, phrases, error = result
+            with self.lock:
+                request = self.pending.pop(request_id, None)
+            if request:
+                request[1:] = [phrases, error]
+                request[0].set()
+    
+    def check_workers(self):
+        # once a worker has died, fails every pending request
+        if self.error == None:
+            for worker in self.workers:
+                if not worker.is_alive():
+                    self.error = "parse worker {0} died with exit code {1}".format(worker.pid, worker.exitcode)
+                    break
+        if self.error != None:
+            with self.lock:
+                requests = self.pending.values()
+                self.pending.clear()
+            for request in requests:
+                request[1:] = [None, self.error]
+                request[0].set()
+    
+    def parse(self, text, **options):
+        # takes the same options as `CompiledModel.parse`, except tag_processing_functions (given to the pool)
+        return self.parse_many([text], **options)[0]
+    
+    def parse_many(self, texts, chunk_size=64, **options):
+        # splits `texts` into requests of `chunk_size` texts, each parsed with `CompiledModel.parse_many`
+        if self.error != None:
+            raise RuntimeError("parse worker failed:\n" + self.error)
+        requests = []
+        for start in xrange(0, len(texts), chunk_size):
+            request = [threading.Event(), None, None]
+            with self.lock:
+                request_id = next(self.request_ids)
+                self.pending[request_id] = request
+            self.requests.put((request_id, texts[start:start+chunk_size], options))
+            requests.append(request)
+        for request in requests:
+            request[0].wait()
+        phrases = []
+        for done, chunk_phrases, error in requests:
+            if error:
+                raise RuntimeError("parse worker failed:\n" + error)
+            phrases.extend(chunk_phrases)
+        return phrases
+    
+    def close(self):
+        for worker in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.results.put(None)
+        self.collector.join()
+
+def parse_worker(model, tag_processing_functions, requests, results):
+    while True:
+        request = requests.get()
+        if request == None:
+            break
+        request_id, texts, options = request
+        try:
+            results.put((request_id, model.parse_many(texts, tag_processing_functions=tag_processing_functions, **options), None))
+        except Exception:
+            results.put((request_id, None, traceback.format_exc()))
+
+def parse_phrase(text, examples, state_regexes=None, supplemental_tags={}, tag_processing_functions={}, weight_first_word=1.5, intent_bonuses={}, allowed_intents=None, beam_width=None, beam_threshold=None):
+    # one-off parse; to parse many texts against the same examples, build a `CompiledModel` once and reuse it
+    model = CompiledModel(examples, state_regexes, supplemental_tags, beam_width=beam_width, beam_threshold=beam_threshold)
+    return model.parse(text, intent_bonuses=intent_bonuses, allowed_intents=allowed_intents, tag_processing_functions=tag_processing_functions, weight_first_word=weight_first_word)
+
+if __name__ == '__main__':
+    # checks that the bounded, joint, numpy, prefix-cached and incremental decoders parse the bundled transcripts'
+    # examples (and their first halves) exactly as the plain per-intent decoder does. run from the repo directory
+    import json
+    import bot
+    import null_phrase
+    b = bot.Bot([json.load(open(filename)) for filename in ['polite.json', 'if_missing_fields.json', 'ask_weather.json', 'lookup_addon.json', 'weather_addon.json']])
+    examples = [example for template in b.templates_in_order for example in template.examples] + null_phrase.examples()
+    texts = set()
+    for example in examples:
+        words = example.text().split()
+        texts.update([u" ".join(words), u" ".join(words[:(len(words) + 1) / 2]), u" ".join(words).lower() + u"?"])
+    convo_bonuses = dict(b.base_intent_bonuses)
+    convo_bonuses.update(b.convo_intent_bonuses(bot.Convo()))
+    profiles = [({}, None), (convo_bonuses, b.allowed_intents_for_senders['user'])]
+    plain = CompiledModel(examples)
+    cached = CompiledModel(examples, prefix_cache_size=2000)
+    variants = [('bound', plain, {'bound': True}), ('joint', CompiledModel(examples, joint=True), {}),
+                ('prefix cache', cached, {}), ('prefix cache, bound', cached, {'bound': True})]
+    if numpy:
+        variants.append(('numpy', CompiledModel(examples, backend='numpy'), {}))
+    for bonuses, allowed_intents in profiles:
+        for text in sorted(texts):
+            expected = repr(plain.parse(text, bonuses, allowed_intents))
+            for name, model, options in variants:
+                assert repr(model.parse(text, bonuses, allowed_intents, **options)) == expected, (name, text)
+            # type it, checking at each word, then delete and retype its last few characters:
+            session = ParseSession(plain, u"", bonuses, allowed_intents)
+            for i, char in enumerate(text):
+                session.feed(char)
+                if char == u" ":
+                    assert repr(session.best()) == repr(plain.parse(text[:i+1], bonuses, allowed_intents)), ('session', text[:i+1])
+            session.backspace(4)
+            assert repr(session.best()) == repr(plain.parse(text[:-4], bonuses, allowed_intents)), ('session', text[:-4])
+            session.feed(text[-4:])
+            assert repr(session.best()) == expected, ('session', text)
+    print "{0} texts parse the same with: {1}, and ParseSession".format(len(texts), ", ".join(name for name, model, options in variants))
@@ -6,11 +6,18 @@ from parse_example import parse_example_to_phrase
 import sys
 import json
 import imp
-from shared import plugin_dir, WorkingDirAs, get_cached_data_structure
+from shared import plugin_dir, WorkingDirAs
 import i18n
-import codecs
+import hashlib
+import pickle
+import tempfile
+import time
+import multiprocessing
+import traceback
 
-def create_example_phrases():
+def create_example_phrases(cache=None):
+    # (example phrases, plugins to always invoke, regexes, cache), re-reading only the plugins whose examples.txt changed
+    # since `cache` (by default, the one in NLPModel.pickle). pass the returned cache to the next call
     example_phrases = []
     plugins_to_always_invoke = set()
     regexes = {}
@@ -27,6 +34,24 @@ def create_example_phrases():
     example_phrases.append(commanding.Phrase("", [["~uirguieg", "hgeough egoiheroi ehgiegeg riehg hierohgi"]]))
     example_phrases.append(commanding.Phrase("", [["~uirguieg", "hgeoughegoiheroi"]]))
 
+    if cache == None: cache = load_cache()
+    examples_files = plugin_examples_files()
+    new_cache = {}
+    for plugin_name in sorted(examples_files):
+        new_cache[plugin_name] = cached_plugin_examples(cache.get(plugin_name), plugin_name, examples_files[plugin_name])
+        plugin_phrases, always_invoke, plugin_regexes = new_cache[plugin_name]['examples']
+        example_phrases += plugin_phrases
+        if always_invoke:
+            plugins_to_always_invoke.add(plugin_name)
+        regexes.update(plugin_regexes)
+    if new_cache != cache:
+        write_cache(new_cache)
+    
+    return (example_phrases, plugins_to_always_invoke, regexes, new_cache)
+
+def plugin_examples_files():
+    # plugin name -> the path of its (localized) examples.txt, for each plugin bundle that has one
+    examples_files = {}
     for plugin in os.listdir(plugin_dir):
         if os.path.isdir(os.path.join(plugin_dir, plugin)):
             plugin_name, extension = os.path.splitext(plugin)
@@ -34,28 +59,80 @@ def create_example_phrases():
                 examples_file = os.path.join(plugin_dir, plugin, "examples.txt")
                 examples_file = i18n.find_localized_path(examples_file)
                 if os.path.exists(examples_file):
-                    for line in codecs.open(examples_file, 'r', 'utf-8'):
-                        line = line.strip()
-                        if line.startswith('!'):
-                            if line == '!always_invoke':
-                                plugins_to_always_invoke.add(plugin_name)
-                            elif line.startswith('!regex '):
-                                _, field_name, regex = line.split(' ', 2)
-                                regexes[field_name[1:]] = regex
-                        elif len(line):
-                            example_phrases.append(parse_example_to_phrase(plugin_name, line))
-    
-    return (example_phrases, plugins_to_always_invoke, regexes)
+                    examples_files[plugin_name] = examples_file
+    return examples_files
+
+def parse_plugin_examples(plugin_name, text):
+    # (example phrases, whether to always invoke the plugin, regexes) from the text of its examples.txt
+    example_phrases = []
+    always_invoke = False
+    regexes = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('!'):
+            if line == '!always_invoke':
+                always_invoke = True
+            elif line.startswith('!regex '):
+                _, field_name, regex = line.split(' ', 2)
+                regexes[field_name[1:]] = regex
+        elif len(line):
+            example_phrases.append(parse_example_to_phrase(plugin_name, line))
+    return (example_phrases, always_invoke, regexes)
 
+# NLPModel.pickle holds, for each plugin, what parse_plugin_examples got from its examples.txt, along with the file's
+# path, (mtime, size) and sha1. a plugin is only re-parsed if its file's mtime or size changed and so did its contents
 cache_path = os.path.join(plugin_dir, "NLPModel.pickle")
-cache_max_age = 20 # 20 sec
-(example_phrases, plugins_to_always_invoke, regexes) = get_cached_data_structure(cache_path, cache_max_age, create_example_phrases)
+cache_version = 2
+
+def cached_plugin_examples(entry, plugin_name, examples_file):
+    # the cache entry for a plugin, reusing `entry` (its old one, or None) if its examples.txt hasn't changed
+    stat = os.stat(examples_file)
+    stamp = (stat.st_mtime, stat.st_size)
+    if entry and entry['path'] == examples_file and entry['stamp'] == stamp:
+        return entry
+    data = open(examples_file, 'rb').read()
+    digest = hashlib.sha1(data).hexdigest()
+    if entry and entry['path'] == examples_file and entry['hash'] == digest:
+        examples = entry['examples'] # touched, but not changed
+    else:
+        examples = parse_plugin_examples(plugin_name, data.decode('utf-8'))
+    return {"path": examples_file, "stamp": stamp, "hash": digest, "examples": examples}
+
+def load_cache():
+    try:
+        with open(cache_path, 'rb') as f:
+            version, cache = pickle.load(f)
+    except Exception:
+        return {} # missing, unreadable, or written by an older version (unpickling garbage can raise nearly anything)
+    return cache if version == cache_version else {}
+
+def write_cache(cache):
+    # writes to a temporary file and renames it over the cache, so other processes never read half a cache
+    fd, temp_path = tempfile.mkstemp(prefix="NLPModel.", suffix=".tmp", dir=plugin_dir)
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump((cache_version, cache), f, pickle.HIGHEST_PROTOCOL)
+    os.rename(temp_path, cache_path)
+
+(example_phrases, plugins_to_always_invoke, regexes, examples_cache) = create_example_phrases()
+
+def refresh_examples():
+    # picks up edits to the plugins' examples.txt files, so a long-lived process (see --serve) doesn't parse with
+    # stale examples. the compiled models are rebuilt only if some plugin's examples actually changed
+    global example_phrases, plugins_to_always_invoke, regexes, examples_cache, compiled_models
+    examples = create_example_phrases(examples_cache)
+    def contents(cache):
+        return sorted((plugin_name, entry['path'], entry['hash']) for plugin_name, entry in cache.iteritems())
+    if contents(examples[3]) != contents(examples_cache):
+        (example_phrases, plugins_to_always_invoke, regexes, examples_cache) = examples
+        compiled_models = commanding.LRUCache(MAX_COMPILED_MODELS)
+    else:
+        examples_cache = examples[3] # keeps the new stamps, so the files aren't hashed again
 
 tag_processing_functions = {}
 
 def parse_query(query, supplemental_tags):
     supplemental_tags = merge_dicts([supplemental_tags, special_tag_supplemental_examples])
-    parsed = commanding.parse_phrase(query, example_phrases, regexes, supplemental_tags, tag_processing_functions)
+    parsed = compiled_model(supplemental_tags).parse(query, tag_processing_functions=tag_processing_functions)
     if parsed == None or parsed.intent == '':
         return None
     parsed = parsed.with_strings_not_unicode() # for compatibility; TODO: add flag in `info.json` to pass unicode to plugin.py instead of utf-8
@@ -72,29 +149,117 @@ for special_field in [date_field]:
   tag_processing_functions[special_field.name] = special_field.transform
   special_tag_supplemental_examples[special_field.name] = special_field.examples
 
+# the model only depends on the supplemental tags, so build it once for each distinct set, keeping the most recently used:
+MAX_COMPILED_MODELS = 8
+compiled_models = commanding.LRUCache(MAX_COMPILED_MODELS)
+def compiled_model(supplemental_tags):
+  key = json.dumps(supplemental_tags, sort_keys=True)
+  model = compiled_models.get(key)
+  if model == None:
+    model = commanding.CompiledModel(example_phrases, regexes, supplemental_tags)
+    compiled_models[key] = model
+  return model
+compiled_model(special_tag_supplemental_examples)
+
 import inspect
 
-if __name__=='__main__':
-    query = sys.argv[1].decode('utf-8')
+# per worker process: plugin.py path -> (mtime, its `results` function, how many arguments that takes)
+loaded_plugins = {}
+
+def plugin_results_function(plugin, plugin_path):
+    # loads a plugin's plugin.py the first time, and again whenever the file changes
+    mtime = os.stat(plugin_path).st_mtime
+    if plugin_path not in loaded_plugins or loaded_plugins[plugin_path][0] != mtime:
+        with WorkingDirAs(os.path.split(plugin_path)[0]):
+            # a module name per plugin, so loading one doesn't overwrite another's globals:
+            plugin_module = imp.load_source("plugin_{0}".format(plugin), plugin_path)
+        loaded_plugins[plugin_path] = (mtime, plugin_module.results, len(inspect.getargspec(plugin_module.results)[0]))
+    return loaded_plugins[plugin_path][1:]
+
+class PluginError(Exception):
+    # a plugin raised; its message is the traceback, since the exception itself may not survive the trip back from the worker
+    pass
+
+def run_plugin(plugin, args, query, parsed_object):
+    # runs in a PluginHost worker; returns a list of result dicts, or None
+    try:
+        return run_plugin_in_worker(plugin, args, query, parsed_object)
+    except Exception:
+        raise PluginError(traceback.format_exc())
+
+def run_plugin_in_worker(plugin, args, query, parsed_object):
+    plugin_path = os.path.join(plugin_dir, plugin+'.bundle', 'plugin.py')
+    results, n_arguments = plugin_results_function(plugin, plugin_path)
+    arguments = [args, query]
+    if n_arguments == 3:
+        arguments.append(parsed_object)
+    with WorkingDirAs(os.path.split(plugin_path)[0]):
+        res = results(*arguments) # can return a dict or a list of result dicts
+    if type(res) == dict:
+        return [res]
+    elif type(res) == list:
+        return res
+    return None
+
+class PluginHost(object):
+    # runs plugins concurrently on a pool of long-lived worker processes (processes, not threads, since plugins
+    # run in their bundle's directory). each worker keeps the plugins it has loaded; see plugin_results_function.
+    # a plugin that takes longer than its timeout (`timeouts`, or `timeout` seconds) is left out of the results,
+    # and the pool is restarted afterwards so the stuck worker doesn't hold up later queries. a plugin that raises
+    # is left out as well, and its traceback logged to stderr
+    def __init__(self, processes=4, timeout=10, timeouts={}):
+        self.processes = processes
+        self.timeout = timeout
+        self.timeouts = timeouts
+        self.pool = multiprocessing.Pool(processes)
+    
+    def run(self, arguments_for_plugins, query, parsed_object):
+        # `arguments_for_plugins` maps each plugin to run to its parsed arguments (or None)
+        start = time.time()
+        pending = dict((plugin, self.pool.apply_async(run_plugin, (plugin, args, query, parsed_object))) for plugin, args in arguments_for_plugins.iteritems())
+        results = {}
+        timed_out = []
+        for plugin, pending_result in pending.iteritems():
+            deadline = start + self.timeouts.get(plugin, self.timeout)
+            try:
+                res = pending_result.get(max(0, deadline - time.time()))
+            except multiprocessing.TimeoutError:
+                timed_out.append(plugin)
+                continue
+            except Exception as e:
+                print >> sys.stderr, "plugin {0} failed:\n{1}".format(plugin, e)
+                continue
+            if res != None:
+                results[plugin] = res
+        if len(timed_out):
+            print >> sys.stderr, "plugins timed out:", ", ".join(timed_out)
+            self.pool.terminate()
+            self.pool = multiprocessing.Pool(self.processes)
+        return results
+    
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+def invoke_plugins(host, query, supplemental_tags):
+    refresh_examples()
     plugins_to_invoke = set(plugins_to_always_invoke)
-    parsed = parse_query(query, supplemental_tags=json.loads(sys.argv[2]))
+    parsed = parse_query(query, supplemental_tags=supplemental_tags)
     # print 'PARSED', parsed
     if parsed != None:
         plugins_to_invoke.add(parsed['plugin'])
-    
-    results = {}
-    for plugin in plugins_to_invoke:
-        plugin_path = os.path.join(plugin_dir, plugin+'.bundle', 'plugin.py')
-        with WorkingDirAs(os.path.split(plugin_path)[0]):
-            plugin_module = imp.load_source("plugin", plugin_path)
-            args = parsed['arguments'] if parsed and parsed['plugin'] == plugin else None
-            arguments = [args, query]
-            if len(inspect.getargspec(plugin_module.results)[0]) == 3:
-                arguments.append(parsed['object'])
-            res = plugin_module.results(*arguments) # can return a dict or a list of result dicts
-            if type(res) == dict:
-                results[plugin] = [res]
-            elif type(res) == list:
-                results[plugin] = res
-    
-    print json.dumps(results)
+    arguments_for_plugins = dict((plugin, parsed['arguments'] if parsed and parsed['plugin'] == plugin else None) for plugin in plugins_to_invoke)
+    return host.run(arguments_for_plugins, query, parsed['object'] if parsed else None)
+
+if __name__=='__main__':
+    host = PluginHost()
+    if sys.argv[1:] == ['--serve']:
+        # stays up, so plugins are only loaded once: reads a JSON {"query": ..., "supplemental_tags": ...} per line
+        # from stdin, and writes the results for each as a line of JSON
+        for line in iter(sys.stdin.readline, ''):
+            request = json.loads(line)
+            print json.dumps(invoke_plugins(host, request['query'], request.get('supplemental_tags', {})))
+            sys.stdout.flush()
+    else:
+        print json.dumps(invoke_plugins(host, sys.argv[1].decode('utf-8'), json.loads(sys.argv[2])))
+    host.close()